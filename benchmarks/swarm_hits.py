@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+
+##    Copyright 2016 Davide Albanese <davide.albanese@gmail.com>
+##    Copyright 2016 Fondazione Edmund Mach (FEM)
+
+##    This file is part of micca.
+##
+##    micca is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    micca is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with micca.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the hits writing step of the denovo_swarm protocol (see
+micca.api.otu.denovo_swarm()). For each number of OTUs, a synthetic swarm
+output file and dereplication .uc file are generated (2 amplicons and 3
+reads per OTU) and the hits file is written using:
+
+* index: the in-memory index of the .uc file, OTU ids in a set;
+* sqlite: the SQLite database (used when the index does not fit in
+  memory), OTU ids in a set;
+* list: the in-memory index, OTU ids in a list (O(n) membership test, as
+  before version 1.8.0). Quadratic, skipped for more than --list-max OTUs.
+
+The hits files written by the different methods must be identical. Run
+from the repository root:
+
+    python benchmarks/swarm_hits.py -n 10000 100000 1000000
+"""
+
+import os
+import sys
+import csv
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import micca.api.otu
+
+
+def _write_input(n, swarms_fn, uc_fn):
+    """Writes the swarm output file and the .uc file of n OTUs."""
+
+    with open(swarms_fn, 'wb') as swarms_handle, \
+         open(uc_fn, 'wb') as uc_handle:
+        centroids = []
+        for i in range(n):
+            a, b = "u{:d}a".format(i), "u{:d}b".format(i)
+            swarms_handle.write("{};size=3; {};size=2;\n".format(a, b))
+            for derep, reads in [(a, [1, 2]), (b, [3])]:
+                uc_handle.write("S\t0\t150\t*\t*\t*\t*\t*\t{}\t*\n".format(
+                    derep))
+                for j in reads:
+                    uc_handle.write("H\t0\t150\t100.0\t+\t0\t0\t=\t"
+                                    "r{:d}_{:d}\t{}\n".format(i, j, derep))
+            centroids.append("C\t0\t3\t*\t*\t*\t*\t*\t{}\t*\n".format(a))
+            centroids.append("C\t0\t2\t*\t*\t*\t*\t*\t{}\t*\n".format(b))
+        uc_handle.writelines(centroids)
+
+
+def _write_hits(hits, hits_fn):
+    """Writes the hits as micca.api.otu.denovo_swarm() does. Returns the
+    elapsed time in seconds.
+    """
+
+    start = time.time()
+    with open(hits_fn, 'wb') as hits_handle:
+        hits_writer = csv.writer(hits_handle, delimiter='\t',
+                                 lineterminator='\n')
+        hits_writer.writerows((query, otuid, '*') for query, otuid in hits)
+    return time.time() - start
+
+
+def _benchmark(n, tmp_dir, list_max):
+    """Returns the dict method -> elapsed time (None if skipped)."""
+
+    swarms_fn = os.path.join(tmp_dir, "swarms")
+    uc_fn = os.path.join(tmp_dir, "uc")
+    sqlite_fn = os.path.join(tmp_dir, "sqlite")
+    _write_input(n, swarms_fn, uc_fn)
+    otuids = ["u{:d}a".format(i) for i in range(n)]
+
+    times, hits_fns = dict(), dict()
+    for method in ["index", "sqlite", "list"]:
+        hits_fns[method] = os.path.join(tmp_dir, "hits_" + method)
+        if method == "index":
+            hits = micca.api.otu._swarm_hits_index(swarms_fn, set(otuids),
+                                                   uc_fn)
+        elif method == "sqlite":
+            hits = micca.api.otu._swarm_hits_sqlite(swarms_fn, set(otuids),
+                                                    uc_fn, sqlite_fn)
+        elif n <= list_max:
+            hits = micca.api.otu._swarm_hits_index(swarms_fn, otuids, uc_fn)
+        else:
+            times[method] = None
+            continue
+        times[method] = _write_hits(hits, hits_fns[method])
+        if os.path.exists(sqlite_fn):
+            os.remove(sqlite_fn)
+
+    with open(hits_fns["index"], 'rb') as index_handle:
+        index_hits = index_handle.read()
+    for method in ["sqlite", "list"]:
+        if times[method] is not None:
+            with open(hits_fns[method], 'rb') as hits_handle:
+                if hits_handle.read() != index_hits:
+                    raise ValueError("{:d} OTUs: {} and index hits differ"
+                                     .format(n, method))
+    return times
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the denovo_swarm hits writing step.")
+    parser.add_argument('-n', '--notus', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help="numbers of OTUs (default %(default)s).")
+    parser.add_argument('--list-max', type=int, default=100000,
+                        help="maximum number of OTUs for the list method "
+                        "(default %(default)s).")
+    args = parser.parse_args(argv)
+
+    sys.stdout.write("{:>10} {:>10} {:>10} {:>10}\n".format(
+        "OTUs", "index", "sqlite", "list"))
+    for n in args.notus:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            times = _benchmark(n, tmp_dir, args.list_max)
+        finally:
+            shutil.rmtree(tmp_dir)
+        sys.stdout.write("{:>10,d} {}\n".format(n, " ".join(
+            "{:>10}".format("-" if times[method] is None
+                            else "{:.2f} s".format(times[method]))
+            for method in ["index", "sqlite", "list"])))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
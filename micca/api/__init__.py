@@ -1,11 +1,12 @@
 from _convert import convert, CONVERT_INPUT_FMTS, CONVERT_OUTPUT_FMTS
 from _filter import filter
-from _stats import stats
+from _stats import stats, stats_combine
 from _filterstats import filterstats
 from _merge import merge
 from _mergepairs import mergepairs
 from _split import split
 from _trim import trim
+from _preprocess import preprocess
 from _tobiom import tobiom
 import otu
 import classify
@@ -15,5 +16,5 @@ import root
 import table
 
 __all__ = ["convert", "CONVERT_INPUT_FMTS", "CONVERT_OUTPUT_FMTS", "filter",
-           "stats", "filterstats", "merge", "mergepairs", "split", "tobiom",
-           "trim"]
+           "stats", "stats_combine", "filterstats", "merge", "mergepairs",
+           "split", "tobiom", "trim", "preprocess"]
@@ -19,14 +19,89 @@
 from __future__ import division
 
 import sys
+import string
 
 from Bio import SeqIO
 from Bio.SeqIO.QualityIO import PairedFastaQualIterator
 
+import micca.ioutils
+import micca.seq
+
 
 CONVERT_INPUT_FMTS = sorted(SeqIO._FormatToIterator.keys() + ["fasta-qual"])
 CONVERT_OUTPUT_FMTS = sorted(SeqIO._FormatToWriter.keys())
 
+# ASCII offset and max. quality score of the FASTQ input formats converted
+# without building SeqRecord objects
+_RAW_FASTQ_INPUT_FMTS = {
+    "fastq": (33, 93),
+    "fastq-sanger": (33, 93),
+    "fastq-illumina": (64, 62)}
+
+# output formats written without building SeqRecord objects (FASTQ output
+# is Sanger/Illumina 1.8+)
+_RAW_OUTPUT_FMTS = {
+    "fasta": "fasta",
+    "fastq": "fastq",
+    "fastq-sanger": "fastq"}
+
+# max. PHRED quality score in a Sanger FASTQ file
+_SANGER_MAXQ = 93
+
+# line width of the FASTA output (as Bio.SeqIO.write())
+_FASTA_WIDTH = 60
+
+
+def _raw_supported(input_fmt, output_fmt, defaultq):
+    """Returns True if the conversion can be performed by _convert_raw().
+    """
+
+    if output_fmt not in _RAW_OUTPUT_FMTS:
+        return False
+    if input_fmt == "fasta":
+        return 0 <= defaultq <= _SANGER_MAXQ
+    return input_fmt in _RAW_FASTQ_INPUT_FMTS
+
+
+def _fastq_records(handle, input_fmt):
+    """Yields the (title, sequence, quality) string tuples of a FASTQ file,
+    with the quality strings converted to Sanger. Raises ValueError on
+    invalid quality characters, as Bio.SeqIO.parse().
+    """
+
+    offset, maxq = _RAW_FASTQ_INPUT_FMTS[input_fmt]
+    valid = "".join(chr(offset + q) for q in range(maxq+1))
+    table = string.maketrans(
+        valid, "".join(chr(q + micca.seq.FASTQ_ASCII) for q in range(maxq+1)))
+
+    for title, seq, qual in micca.seq.raw_records(handle, "fastq"):
+        if qual.translate(None, valid):
+            raise ValueError("Invalid character in quality string")
+        yield title, seq, qual.translate(table)
+
+
+def _convert_raw(input_handle, output_handle, input_fmt, output_fmt,
+                 defaultq):
+    """Converts between FASTA and FASTQ formats processing the records as
+    strings, without building SeqRecord objects. The output is the same as
+    Bio.SeqIO.write(). Returns the number of records converted.
+    """
+
+    if input_fmt == "fasta":
+        qualchar = chr(defaultq + micca.seq.FASTQ_ASCII)
+        records = ((title, seq, qualchar * len(seq)) for title, seq, qual in
+                   micca.seq.raw_records(input_handle, "fasta"))
+    else:
+        records = _fastq_records(input_handle, input_fmt)
+
+    fmt = _RAW_OUTPUT_FMTS[output_fmt]
+    count = 0
+    for title, seq, qual in records:
+        micca.seq.raw_write(output_handle, title, seq, qual, fmt=fmt,
+                            wrap=_FASTA_WIDTH)
+        count += 1
+    return count
+
 
 def convert(input_fn, output_fn, qual_fn=None, input_fmt="fastq",
             output_fmt="fasta", defaultq=40):
@@ -48,16 +123,25 @@ def convert(input_fn, output_fn, qual_fn=None, input_fmt="fastq",
         raise ValueError("output format 'fasta-qual' requires an input "
                          "quality file")
 
+    # FASTA/FASTQ conversions
+    if _raw_supported(input_fmt, output_fmt, defaultq):
+        with micca.ioutils.open_input(input_fn, 'rU') as input_handle:
+            with micca.ioutils.open_output(output_fn, 'wb') as output_handle:
+                count = _convert_raw(input_handle, output_handle, input_fmt,
+                                     output_fmt, defaultq)
+        sys.stdout.write("{:d} sequences converted\n".format(count))
+        return
+
     # parse records
-    input_handle = open(input_fn, 'rU')
+    input_handle = micca.ioutils.open_input(input_fn, 'rU')
     if input_fmt == "fasta-qual":
-        qual_handle = open(qual_fn, 'rU')
+        qual_handle = micca.ioutils.open_input(qual_fn, 'rU')
         records = PairedFastaQualIterator(input_handle, qual_handle)
     else:
         records = SeqIO.parse(input_handle, input_fmt)
 
     # write records
-    output_handle = open(output_fn, 'wb')
+    output_handle = micca.ioutils.open_output(output_fn, 'wb')
     count = SeqIO.write(add_phred_quality(records, defaultq),
                         output_handle, output_fmt)
 
@@ -18,11 +18,98 @@
 
 from __future__ import division
 
+import os.path
+import itertools
+import shutil
+import multiprocessing
+from cStringIO import StringIO
+
+import micca.ioutils
 import micca.tp
+import micca.seq
+
+
+# size in bytes of the chunks processed in parallel by the native engine
+_CHUNK_SIZE = 16*1024*1024
+
+# FASTA line width of the native engine (as VSEARCH)
+_FASTA_WIDTH = 80
+
+# buffer size in bytes of the copies of the VSEARCH output
+_BUFFER_SIZE = 4*1024*1024
+
+
+def _filter_format(records, maxee_rate, maxns, minlen, trunclen, output_fmt):
+    """Filters the records and returns the output records formatted as a
+    string.
+    """
+
+    output_handle = StringIO()
+    for title, seq, qual in micca.seq.filter_records(
+            records, maxee_rate, maxns, minlen, trunclen):
+        micca.seq.raw_write(output_handle, title, seq, qual, fmt=output_fmt,
+                            wrap=_FASTA_WIDTH)
+    return output_handle.getvalue()
+
+
+def _filter_chunk(args):
+    """Filters a chunk of a FASTQ file or, if 'chunk' is a string, a block
+    of FASTQ records (pool worker, see _filter_format()).
+    """
+
+    input_fn, chunk, maxee_rate, maxns, minlen, trunclen, output_fmt = args
+
+    if isinstance(chunk, basestring):
+        records = micca.seq.fastq_parse_block(chunk, input_fn)
+    else:
+        records = micca.seq.fastq_read_chunk(input_fn, *chunk)
+    return _filter_format(records, maxee_rate, maxns, minlen, trunclen,
+                          output_fmt)
+
+
+def _filter_native(input_fn, output_fn, maxee_rate, maxns, minlen, trunclen,
+                   output_fmt, threads):
+    """Filters the FASTQ file in-process, splitting it in chunks processed
+    in parallel when threads > 1. Compressed files are decompressed by the
+    main process and sent to the workers in blocks. Multi-line FASTQ files
+    are not supported.
+    """
+
+    input_handle = None
+    if micca.ioutils.compression(input_fn) is None:
+        chunks = micca.seq.fastq_chunks(input_fn, _CHUNK_SIZE)
+    else:
+        input_handle = micca.ioutils.open_input(input_fn, 'rb')
+        chunks = micca.seq.fastq_blocks(input_handle, _CHUNK_SIZE)
+    args = ((input_fn, chunk, maxee_rate, maxns, minlen, trunclen,
+             output_fmt) for chunk in chunks)
+
+    pool = None
+    try:
+        with micca.ioutils.open_output(output_fn, 'wb') as output_handle:
+            if threads > 1:
+                # a few chunks at a time, decompressed blocks are kept in
+                # memory until processed
+                pool = multiprocessing.Pool(threads)
+                while True:
+                    batch = list(itertools.islice(args, 2*threads))
+                    if not batch:
+                        break
+                    for output in pool.imap(_filter_chunk, batch):
+                        output_handle.write(output)
+            else:
+                for arg in args:
+                    output_handle.write(_filter_chunk(arg))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if input_handle is not None:
+            input_handle.close()
 
 
 def filter(input_fn, output_fn, maxee_rate, maxns=None, minlen=1, trunc=False,
-           output_fmt="fasta"):
+           output_fmt="fasta", engine="vsearch", threads=1):
         
     if trunc:
         filter_minlen = 1
@@ -30,18 +117,43 @@ def filter(input_fn, output_fn, maxee_rate, maxns=None, minlen=1, trunc=False,
     else:
         filter_minlen = minlen
         filter_trunclen = None
+
+    if engine == "native":
+        _filter_native(input_fn, output_fn, maxee_rate, maxns, filter_minlen,
+                       filter_trunclen, output_fmt, threads)
+        return
+    elif engine != "vsearch":
+        raise ValueError("engine {} not supported".format(engine))
         
+    # compressed output files are written by VSEARCH to a temporary file
+    output_dir = os.path.dirname(output_fn)
+    vsearch_fn = output_fn
+    if micca.ioutils.is_compressed_output(output_fn):
+        vsearch_fn = micca.ioutils.make_tempfile(output_dir)
+
     fastqout_fn, fastaout_fn = None, None
     if output_fmt == "fasta":
-        fastaout_fn = output_fn
+        fastaout_fn = vsearch_fn
     else:
-        fastqout_fn = output_fn
+        fastqout_fn = vsearch_fn
         
-    micca.tp.vsearch.fastq_filter(
-        input_fn,
-        fastqout_fn=fastqout_fn,
-        fastaout_fn=fastaout_fn,
-        fastq_trunclen=filter_trunclen,
-        fastq_minlen=filter_minlen,
-        fastq_maxee_rate=maxee_rate/100.,
-        fastq_maxns=maxns)
+    input_fifo = micca.ioutils.InputFifo(input_fn, output_dir)
+    try:
+        micca.tp.vsearch.fastq_filter(
+            input_fifo.name,
+            fastqout_fn=fastqout_fn,
+            fastaout_fn=fastaout_fn,
+            fastq_trunclen=filter_trunclen,
+            fastq_minlen=filter_minlen,
+            fastq_maxee_rate=maxee_rate/100.,
+            fastq_maxns=maxns)
+
+        if vsearch_fn != output_fn:
+            with open(vsearch_fn, 'rb') as vsearch_handle, \
+                 micca.ioutils.open_output(output_fn, 'wb') as output_handle:
+                shutil.copyfileobj(vsearch_handle, output_handle,
+                                   _BUFFER_SIZE)
+    finally:
+        input_fifo.close()
+        if (vsearch_fn != output_fn) and os.path.exists(vsearch_fn):
+            os.remove(vsearch_fn)
@@ -18,8 +18,11 @@
 
 from __future__ import division
 
+import sys
 import os
 import os.path
+import itertools
+import multiprocessing
 
 import matplotlib
 matplotlib.use('Agg')
@@ -29,49 +32,182 @@ import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
+import micca.ioutils
+import micca.seq
 
-def _stats(input_fn, topn=None, maxeerates=[0.25, 0.5, 0.75, 1, 1.25, 1.5],
-           maxns=None):
-
-    fastq_ascii = 33
-
-    nseqs = 0
-    eerate_minlen = np.array([], dtype=np.int, order='C')
-    eerate_trunclen = np.array([], dtype=np.int, order='C')
-
-    with open(input_fn, "rU") as input_handle:
-        for title, seq, qualstr in FastqGeneralIterator(input_handle):
-            seqlen = len(seq)
-            if (seqlen < 1):
-                continue
-
-            nseqs += 1
-            if seqlen > eerate_minlen.shape[0]:
-                eerate_minlen.resize((seqlen, len(maxeerates)))
-                eerate_trunclen.resize((seqlen, len(maxeerates)))
-
-            seq = seq.upper()
-            qualint = np.fromstring(qualstr, dtype=np.int8)
-            qual = qualint - fastq_ascii
-            pe = 10**(-qual / 10.)
-            ee = np.cumsum(pe)
-            eerate = (ee / np.arange(1, seqlen+1)) * 100
-
-            if maxns is None:
-                for i, m in enumerate(maxeerates):
-                    eerate_minlen[:seqlen, i] += (eerate[-1] <= m)
-                    eerate_trunclen[:seqlen, i] += (eerate <= m)
-            else:
-                nnmask = (np.cumsum([s=='N' for s in seq]) <= maxns)
-                for i, m in enumerate(maxeerates):
-                    eerate_minlen[:seqlen, i] += (
-                        (eerate[-1] <= m) and nnmask[-1])
-                    eerate_trunclen[:seqlen, i] += np.logical_and(
-                        (eerate <= m), nnmask)
-
-            if (topn == nseqs):
+
+# number of records processed at a time
+_BLOCK_SIZE = 4096
+
+# size in bytes of the chunks processed in parallel
+_CHUNK_SIZE = 16*1024*1024
+
+
+def _filterstats_acc(maxeerates):
+    """Returns empty accumulators.
+    """
+
+    return {
+        "nseqs": 0,
+        "eerate_minlen": np.zeros((0, len(maxeerates)), dtype=np.int,
+                                  order='C'),
+        "eerate_trunclen": np.zeros((0, len(maxeerates)), dtype=np.int,
+                                    order='C')}
+
+
+def _filterstats_resize(acc, seqlen):
+    """Extends the accumulators to sequences of length 'seqlen'.
+    """
+
+    for key in ["eerate_minlen", "eerate_trunclen"]:
+        count = acc[key]
+        if seqlen > count.shape[0]:
+            acc[key] = np.zeros((seqlen, count.shape[1]), dtype=count.dtype)
+            acc[key][:count.shape[0]] = count
+
+
+def _filterstats_merge(acc, other):
+    """Adds the accumulators 'other' to 'acc'.
+    """
+
+    maxlen = other["eerate_minlen"].shape[0]
+    _filterstats_resize(acc, maxlen)
+
+    acc["nseqs"] += other["nseqs"]
+    acc["eerate_minlen"][:maxlen] += other["eerate_minlen"]
+    acc["eerate_trunclen"][:maxlen] += other["eerate_trunclen"]
+
+
+def _filterstats_update(acc, seqs, lens, eerate, maxeerates, maxns=None):
+    """Updates the accumulators with a block of reads, given the sequences,
+    their lengths and the expected error rates (see
+    micca.seq.eerate_matrix()). The EE rates of all the reads are compared
+    with all the thresholds at once (reads x positions x thresholds).
+    """
+
+    nseqs, maxlen = eerate.shape
+    nthrs = len(maxeerates)
+
+    acc["nseqs"] += nseqs
+    _filterstats_resize(acc, maxlen)
+
+    mask = np.arange(maxlen) < lens[:, np.newaxis]
+    passed = eerate[:, :, np.newaxis] <= np.asarray(maxeerates, dtype=np.float)
+    passed &= mask[:, :, np.newaxis]
+
+    if maxns is not None:
+        seqint = np.frombuffer("".join(seqs), dtype=np.uint8)
+        isn = np.zeros(mask.shape, dtype=np.bool)
+        isn[mask] = (seqint == ord('N')) | (seqint == ord('n'))
+        passed &= (np.cumsum(isn, axis=1) <= maxns)[:, :, np.newaxis]
+
+    # min. length + truncation: reads passing the filter after the
+    # truncation at position L
+    acc["eerate_trunclen"][:maxlen] += passed.sum(axis=0)
+
+    # min. length: reads of length >= L passing the filter
+    passed_last = passed[np.arange(nseqs), lens-1]
+    idx = ((lens-1)[:, np.newaxis] * nthrs + np.arange(nthrs))[passed_last]
+    passed_len = np.bincount(idx, minlength=maxlen*nthrs).reshape(
+        maxlen, nthrs)
+    acc["eerate_minlen"][:maxlen] += passed_len[::-1].cumsum(axis=0)[::-1]
+
+
+def _update(acc, records, maxeerates, maxns):
+    """Updates the accumulators with a block of (sequence, quality) string
+    tuples (sequences must not be empty).
+    """
+
+    seqs = [seq for seq, qualstr in records]
+    lens, qualint, mask = micca.seq.qual_matrix(
+        [qualstr for seq, qualstr in records])
+    eerate = micca.seq.eerate_matrix(qualint, mask)
+    _filterstats_update(acc, seqs, lens, eerate, maxeerates, maxns)
+
+
+def _update_records(acc, records, maxeerates, maxns):
+    """Updates the accumulators with a list of (title, sequence, quality)
+    string tuples, in blocks.
+    """
+
+    for i in range(0, len(records), _BLOCK_SIZE):
+        block = [(seq, qualstr) for title, seq, qualstr in
+                 records[i:i+_BLOCK_SIZE] if len(seq) > 0]
+        if block:
+            _update(acc, block, maxeerates, maxns)
+
+
+def _filterstats_chunk(args):
+    """Returns the accumulators for a chunk of a FASTQ file (pool worker).
+    """
+
+    input_fn, start, end, maxeerates, maxns = args
+
+    acc = _filterstats_acc(maxeerates)
+    records = micca.seq.fastq_read_chunk(input_fn, start, end)
+    _update_records(acc, records, maxeerates, maxns)
+    return acc
+
+
+def _filterstats_acc_file(input_fn, topn=None,
+                          maxeerates=[0.25, 0.5, 0.75, 1, 1.25, 1.5],
+                          maxns=None, threads=1, sample=None, seed=0):
+    """Returns the accumulators for a FASTQ file. When threads > 1 the file
+    is split in chunks processed in parallel (topn must be None and the
+    file must not be compressed). When sample is not None, only about
+    'sample' reads sampled at random positions are processed (see
+    micca.seq.fastq_sample()).
+    """
+
+    acc = _filterstats_acc(maxeerates)
+
+    if sample is not None:
+        records = micca.seq.fastq_sample(input_fn, sample, seed=seed)
+        _update_records(acc, records, maxeerates, maxns)
+        return acc
+
+    # compressed files can not be split in chunks
+    if (threads > 1) and (topn is None) and \
+       (micca.ioutils.compression(input_fn) is None):
+        chunks = [(input_fn, start, end, maxeerates, maxns) for start, end in
+                  micca.seq.fastq_chunks(input_fn, _CHUNK_SIZE)]
+        pool = multiprocessing.Pool(threads)
+        try:
+            for chunk_acc in pool.imap(_filterstats_chunk, chunks):
+                _filterstats_merge(acc, chunk_acc)
+        finally:
+            pool.terminate()
+            pool.join()
+        return acc
+
+    with micca.ioutils.open_input(input_fn, "rU") as input_handle:
+        records = FastqGeneralIterator(input_handle)
+        while True:
+            block = list(itertools.islice(records, _BLOCK_SIZE))
+            if not block:
                 break
 
+            block = [(seq, qualstr) for title, seq, qualstr in block
+                     if len(seq) > 0]
+            if topn is not None:
+                block = block[:topn-acc["nseqs"]]
+            if block:
+                _update(acc, block, maxeerates, maxns)
+
+            if (topn == acc["nseqs"]):
+                break
+
+    return acc
+
+
+def _filterstats_tables(acc, maxeerates):
+    """Returns the min. length and the min. length + truncation tables.
+    """
+
+    nseqs = acc["nseqs"]
+    eerate_minlen = acc["eerate_minlen"]
+    eerate_trunclen = acc["eerate_trunclen"]
+
     if nseqs == 0:
         raise EOFError("no valid sequences in input file")
 
@@ -131,21 +267,13 @@ def _plot(minlen, trunclen, output_fn):
     fig.savefig(output_fn, bbox_inches='tight', dpi=300)
 
 
-def filterstats(input_fn, output_dir, topn=None,
-                maxeerates=[0.25, 0.5, 0.75, 1, 1.25, 1.5], maxns=None):
-
-    if not os.path.isdir(output_dir):
-        raise ValueError("directory {} does not exist".format(output_dir))
+def _write(acc, maxeerates, output_dir):
 
     minlen_fn = os.path.join(output_dir, "filterstats_minlen.txt")
     trunclen_fn = os.path.join(output_dir, "filterstats_trunclen.txt")
     plot_fn = os.path.join(output_dir, "filterstats_plot.png")
 
-    minlen, trunclen = _stats(
-        input_fn=input_fn,
-        topn=topn,
-        maxeerates=maxeerates,
-        maxns=maxns)
+    minlen, trunclen = _filterstats_tables(acc, maxeerates)
 
     minlen.to_csv(minlen_fn, sep="\t", float_format="%.3f", index=False)
     trunclen.to_csv(trunclen_fn, sep="\t", float_format="%.3f", index=False)
@@ -161,3 +289,31 @@ def filterstats(input_fn, output_dir, topn=None,
 
     with plt.rc_context(rc=rc):
         _plot(minlen, trunclen, plot_fn)
+
+
+def filterstats(input_fn, output_dir, topn=None,
+                maxeerates=[0.25, 0.5, 0.75, 1, 1.25, 1.5], maxns=None,
+                threads=1, sample=None, seed=0):
+
+    if not os.path.isdir(output_dir):
+        raise ValueError("directory {} does not exist".format(output_dir))
+
+    if (topn is not None) and (sample is not None):
+        raise ValueError("topn and sample are mutually exclusive")
+
+    acc = _filterstats_acc_file(
+        input_fn=input_fn,
+        topn=topn,
+        maxeerates=maxeerates,
+        maxns=maxns,
+        threads=threads,
+        sample=sample,
+        seed=seed)
+
+    if (sample is not None) and (acc["nseqs"] > 0):
+        sys.stdout.write(
+            "{:d} sampled reads, percentages are within +/-{:.2f}% of the "
+            "whole file values (95% confidence)\n".format(
+                acc["nseqs"], micca.seq.sample_pct_bound(acc["nseqs"])))
+
+    _write(acc, maxeerates, output_dir)
@@ -20,14 +20,61 @@ from __future__ import division
 
 import os
 import os.path
+import shutil
+import multiprocessing
 
 from Bio import SeqIO
 
 import micca.seq
+import micca.ioutils
 
 
-def merge(input_fns, output_fn, sep='.', fmt="fastq"):
+# buffer size in bytes of the copies of the temporary files
+_BUFFER_SIZE = 4*1024*1024
 
-    with open(output_fn,'wb') as output_handle:
-        for input_fn in input_fns:
-            micca.seq.append(input_fn, output_handle, fmt=fmt, sep=sep)
+
+def _merge_file(args):
+    """Appends the sample name to the sequences in the input file, writing
+    the temporary output file (pool worker).
+    """
+
+    input_fn, output_tmp_fn, sep, fmt = args
+
+    with open(output_tmp_fn, 'wb') as output_tmp_handle:
+        micca.seq.append(input_fn, output_tmp_handle, fmt=fmt, sep=sep)
+
+
+def _merge_parallel(input_fns, output_handle, sep, fmt, threads, tmp_dir):
+    """Rewrites the input files in parallel into temporary files, appended
+    to the output handle in the input order.
+    """
+
+    output_tmp_fns = [micca.ioutils.make_tempfile(tmp_dir) for input_fn in
+                      input_fns]
+    args = [(input_fn, output_tmp_fn, sep, fmt) for input_fn, output_tmp_fn
+            in zip(input_fns, output_tmp_fns)]
+
+    pool = multiprocessing.Pool(threads)
+    try:
+        for i, _ in enumerate(pool.imap(_merge_file, args)):
+            with open(output_tmp_fns[i], 'rb') as output_tmp_handle:
+                shutil.copyfileobj(output_tmp_handle, output_handle,
+                                   _BUFFER_SIZE)
+            os.remove(output_tmp_fns[i])
+    finally:
+        pool.terminate()
+        pool.join()
+        for output_tmp_fn in output_tmp_fns:
+            if os.path.exists(output_tmp_fn):
+                os.remove(output_tmp_fn)
+
+
+def merge(input_fns, output_fn, sep='.', fmt="fastq", threads=1):
+
+    with micca.ioutils.open_output(output_fn, 'wb') as output_handle:
+        if threads > 1:
+            _merge_parallel(input_fns, output_handle, sep, fmt, threads,
+                            os.path.dirname(output_fn))
+        else:
+            for input_fn in input_fns:
+                micca.seq.append(input_fn, output_handle, fmt=fmt, sep=sep)
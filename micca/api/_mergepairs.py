@@ -22,16 +22,185 @@ import sys
 import os
 import os.path
 import re
+import shutil
 import warnings
+from multiprocessing.pool import ThreadPool
 
 import micca.ioutils
 import micca.seq
 import micca.tp
 
 
+# buffer size in bytes of the copies of the temporary files
+_BUFFER_SIZE = 4*1024*1024
+
+
+def _mergepairs_sample(forward_fn, reverse_fn, sample_name, output_handle,
+                       notmerged_fwd_handle, notmerged_rev_handle, minovlen,
+                       maxdiffs, nostagger, threads, tmp_dir):
+    """Merges the paired reads of a sample and appends the merged and (if
+    the handles are not None) the not merged reads to the output handles,
+    with the sample name appended to the sequence identifiers. Merged reads
+    are read from the VSEARCH standard output while VSEARCH is running. If
+    VSEARCH fails, the output handles are truncated to their initial
+    position. Compressed input files are read through named pipes (see
+    micca.ioutils.InputFifo).
+    """
+
+    if notmerged_fwd_handle is not None:
+        notmerged_fwd_fn_temp = micca.ioutils.make_tempfile(tmp_dir)
+    else:
+        notmerged_fwd_fn_temp = None
+    if notmerged_rev_handle is not None:
+        notmerged_rev_fn_temp = micca.ioutils.make_tempfile(tmp_dir)
+    else:
+        notmerged_rev_fn_temp = None
+
+    def append(handle):
+        micca.seq.append_handle(handle, output_handle, sample_name, "fastq")
+
+    forward_fifo = micca.ioutils.InputFifo(forward_fn, tmp_dir)
+    reverse_fifo = micca.ioutils.InputFifo(reverse_fn, tmp_dir)
+    output_pos = output_handle.tell()
+    try:
+        micca.tp.vsearch.fastq_mergepairs_pipe(
+            forward_fn=forward_fifo.name,
+            reverse_fn=reverse_fifo.name,
+            func=append,
+            fastqout_notmerged_fwd_fn=notmerged_fwd_fn_temp,
+            fastqout_notmerged_rev_fn=notmerged_rev_fn_temp,
+            fastq_minovlen=minovlen,
+            fastq_maxdiffs=maxdiffs,
+            fastq_allowmergestagger=not nostagger,
+            fastq_nostagger=nostagger,
+            threads=threads)
+
+        for fn_temp, handle in [(notmerged_fwd_fn_temp, notmerged_fwd_handle),
+                                (notmerged_rev_fn_temp, notmerged_rev_handle)]:
+            if handle is not None:
+                micca.seq.append(
+                    input_fn=fn_temp,
+                    output_handle=handle,
+                    fmt="fastq",
+                    sample_name=sample_name)
+    except micca.tp.vsearch.VSEARCHError:
+        output_handle.seek(output_pos)
+        output_handle.truncate()
+        raise
+    finally:
+        forward_fifo.close()
+        reverse_fifo.close()
+        for fn_temp in [notmerged_fwd_fn_temp, notmerged_rev_fn_temp]:
+            if fn_temp is not None:
+                os.remove(fn_temp)
+
+
+def _mergepairs_shard(args):
+    """Merges the paired reads of a sample into the temporary files
+    (shards) shard_fns (thread pool worker, see _mergepairs_sample()).
+    Returns a warning message if VSEARCH fails, None otherwise.
+    """
+
+    forward_fn, reverse_fn, sample_name, shard_fns, minovlen, maxdiffs, \
+        nostagger, threads, tmp_dir = args
+
+    handles = [None if fn is None else open(fn, 'wb') for fn in shard_fns]
+    try:
+        _mergepairs_sample(forward_fn, reverse_fn, sample_name, handles[0],
+                           handles[1], handles[2], minovlen, maxdiffs,
+                           nostagger, threads, tmp_dir)
+    except micca.tp.vsearch.VSEARCHError as err:
+        return "{}: VSEARCH error: {}, SKIP\n".format(
+            os.path.basename(forward_fn), err)
+    finally:
+        for handle in handles:
+            if handle is not None:
+                handle.close()
+
+
+def _mergepairs_parallel(samples, handles, minovlen, maxdiffs, nostagger,
+                         threads, jobs, tmp_dir):
+    """Merges 'jobs' samples at a time (each VSEARCH process uses 'threads'
+    threads) into temporary files, appended to the output handles in the
+    input order.
+    """
+
+    shard_fns = [[None if handle is None else
+                  micca.ioutils.make_tempfile(tmp_dir) for handle in handles]
+                 for sample in samples]
+    args = [(input_fn, reverse_fn, sample_name, sample_shard_fns, minovlen,
+             maxdiffs, nostagger, threads, tmp_dir) for (input_fn,
+            reverse_fn, sample_name), sample_shard_fns in
+            zip(samples, shard_fns)]
+
+    pool = ThreadPool(jobs)
+    try:
+        for i, message in enumerate(pool.imap(_mergepairs_shard, args)):
+            if message is not None:
+                warnings.warn(message)
+            for shard_fn, handle in zip(shard_fns[i], handles):
+                if handle is None:
+                    continue
+                if message is None:
+                    with open(shard_fn, 'rb') as shard_handle:
+                        shutil.copyfileobj(shard_handle, handle, _BUFFER_SIZE)
+                os.remove(shard_fn)
+    finally:
+        pool.terminate()
+        pool.join()
+        for shard_fn in sum(shard_fns, []):
+            if (shard_fn is not None) and os.path.exists(shard_fn):
+                os.remove(shard_fn)
+
+
+def _mergepairs_pair(forward_fn, reverse_fn, output_fn, notmerged_fwd_fn,
+                     notmerged_rev_fn, minovlen, maxdiffs, nostagger, threads):
+    """Merges a single pair of files, without appending the sample name to
+    the sequence identifiers. Compressed input files are read through named
+    pipes (see micca.ioutils.InputFifo), compressed output files are written
+    by VSEARCH to temporary files first.
+    """
+
+    output_dir = os.path.dirname(output_fn)
+
+    output_fns = [output_fn, notmerged_fwd_fn, notmerged_rev_fn]
+    vsearch_fns = [micca.ioutils.make_tempfile(output_dir)
+                   if (fn is not None) and
+                   micca.ioutils.is_compressed_output(fn) else fn
+                   for fn in output_fns]
+
+    forward_fifo = micca.ioutils.InputFifo(forward_fn, output_dir)
+    reverse_fifo = micca.ioutils.InputFifo(reverse_fn, output_dir)
+    try:
+        micca.tp.vsearch.fastq_mergepairs(
+            forward_fn=forward_fifo.name,
+            reverse_fn=reverse_fifo.name,
+            fastqout_fn=vsearch_fns[0],
+            fastqout_notmerged_fwd_fn=vsearch_fns[1],
+            fastqout_notmerged_rev_fn=vsearch_fns[2],
+            fastq_minovlen=minovlen,
+            fastq_maxdiffs=maxdiffs,
+            fastq_allowmergestagger=not nostagger,
+            fastq_nostagger=nostagger,
+            threads=threads)
+
+        for fn, vsearch_fn in zip(output_fns, vsearch_fns):
+            if fn != vsearch_fn:
+                with open(vsearch_fn, 'rb') as vsearch_handle, \
+                     micca.ioutils.open_output(fn, 'wb') as output_handle:
+                    shutil.copyfileobj(vsearch_handle, output_handle,
+                                       _BUFFER_SIZE)
+    finally:
+        forward_fifo.close()
+        reverse_fifo.close()
+        for fn, vsearch_fn in zip(output_fns, vsearch_fns):
+            if (fn != vsearch_fn) and os.path.exists(vsearch_fn):
+                os.remove(vsearch_fn)
+
+
 def mergepairs(input_fns, output_fn, reverse_fn=None, notmerged_fwd_fn=None,
                notmerged_rev_fn=None, minovlen=32, maxdiffs=8, pattern="_R1",
-               repl="_R2", sep="_", nostagger=False, threads=1):
+               repl="_R2", sep="_", nostagger=False, threads=1, jobs=1):
 
     if not isinstance(input_fns, list):
         raise ValueError("input_fns must be of type list")
@@ -51,107 +220,60 @@ def mergepairs(input_fns, output_fn, reverse_fn=None, notmerged_fwd_fn=None,
     # if reverse is not None create output files without appending sample names
     # to the sequence ids
     if reverse_fn is not None:
-        micca.tp.vsearch.fastq_mergepairs(
-            forward_fn=input_fns[0],
-            reverse_fn=reverse_fn,
-            fastqout_fn=output_fn,
-            fastqout_notmerged_fwd_fn=notmerged_fwd_fn,
-            fastqout_notmerged_rev_fn=notmerged_rev_fn,
-            fastq_minovlen=minovlen,
-            fastq_maxdiffs=maxdiffs,
-            fastq_allowmergestagger=not nostagger,
-            fastq_nostagger=nostagger,
-            threads=threads)
-    else:
-        # output directory for temp files
-        output_dir = os.path.dirname(output_fn)
+        _mergepairs_pair(input_fns[0], reverse_fn, output_fn,
+                         notmerged_fwd_fn, notmerged_rev_fn, minovlen,
+                         maxdiffs, nostagger, threads)
+        return
 
-        # close output files and create temp files
-        output_fn_temp = micca.ioutils.make_tempfile(output_dir)
-        output_fn_handle = open(output_fn, 'wb')
+    # output directory for temp files
+    output_dir = os.path.dirname(output_fn)
 
-        if notmerged_fwd_fn is not None:
-            notmerged_fwd_fn_temp = micca.ioutils.make_tempfile(output_dir)
-            notmerged_fwd_handle = open(notmerged_fwd_fn, 'wb')
-        else:
-            notmerged_fwd_fn_temp = None
-
-        if notmerged_rev_fn is not None:
-            notmerged_rev_fn_temp = micca.ioutils.make_tempfile(output_dir)
-            notmerged_rev_handle = open(notmerged_rev_fn, 'wb')
-        else:
-            notmerged_rev_fn_temp = None
-
-        # for each input forward file
-        for input_fn in input_fns:
-            input_dir, input_fn_base = os.path.split(input_fn)
-
-            # build the reverse filename
-            reverse_fn_base, n = re.subn(pattern, repl, input_fn_base, count=1)
-            if n == 0:
-                warnings.warn(
-                    "{0}: unable to find pattern '{1}', SKIP\n"
-                    .format(input_fn_base, pattern))
-                continue
-
-            # check the reverse input file
-            reverse_fn = os.path.join(input_dir, reverse_fn_base)
-            if not os.path.isfile(reverse_fn):
-                warnings.warn(
-                    "{}: file does not exist or is not a regular file, SKIP\n"
-                    .format(reverse_fn_base))
-                continue
-
-            # run VSEARCH
-            try:
-                micca.tp.vsearch.fastq_mergepairs(
-                    forward_fn=input_fn,
-                    reverse_fn=reverse_fn,
-                    fastqout_fn=output_fn_temp,
-                    fastqout_notmerged_fwd_fn=notmerged_fwd_fn_temp,
-                    fastqout_notmerged_rev_fn=notmerged_rev_fn_temp,
-                    fastq_minovlen=minovlen,
-                    fastq_maxdiffs=maxdiffs,
-                    fastq_allowmergestagger=not nostagger,
-                    fastq_nostagger=nostagger,
-                    threads=threads)
-            except micca.tp.vsearch.VSEARCHError as err:
-                warnings.warn("{}: VSEARCH error: {}, SKIP\n"
-                              .format(input_fn_base, err))
-                continue
-
-            # append sequences to the outuput files
-            sample_name = re.sub('\s+', '_', input_fn_base.split(sep)[0])
-            micca.seq.append(
-                input_fn=output_fn_temp,
-                output_handle=output_fn_handle,
-                fmt="fastq",
-                sample_name=sample_name)
-
-            if notmerged_fwd_fn is not None:
-                micca.seq.append(
-                    input_fn=notmerged_fwd_fn_temp,
-                    output_handle=notmerged_fwd_handle,
-                    fmt="fastq",
-                    sample_name=sample_name)
+    # build the list of samples (forward file, reverse file, sample name)
+    samples = []
+    for input_fn in input_fns:
+        input_dir, input_fn_base = os.path.split(input_fn)
 
-            if notmerged_rev_fn is not None:
-                micca.seq.append(
-                    input_fn=notmerged_rev_fn_temp,
-                    output_handle=notmerged_rev_handle,
-                    fmt="fastq",
-                    sample_name=sample_name)
+        # build the reverse filename
+        reverse_fn_base, n = re.subn(pattern, repl, input_fn_base, count=1)
+        if n == 0:
+            warnings.warn(
+                "{0}: unable to find pattern '{1}', SKIP\n"
+                .format(input_fn_base, pattern))
+            continue
 
-        # END for input_fn in input_fns:
+        # check the reverse input file
+        reverse_fn = os.path.join(input_dir, reverse_fn_base)
+        if not os.path.isfile(reverse_fn):
+            warnings.warn(
+                "{}: file does not exist or is not a regular file, SKIP\n"
+                .format(reverse_fn_base))
+            continue
 
-        # close output files and remove temp files
-        output_fn_handle.close()
-        os.remove(output_fn_temp)
-        if notmerged_fwd_fn is not None:
-            notmerged_fwd_handle.close()
-            os.remove(notmerged_fwd_fn_temp)
-        if notmerged_rev_fn is not None:
-            notmerged_rev_handle.close()
-            os.remove(notmerged_rev_fn_temp)
+        sample_name = re.sub('\s+', '_', input_fn_base.split(sep)[0])
+        samples.append((input_fn, reverse_fn, sample_name))
 
-    # END else:
+    # open the output files. Compressed files can not be truncated if
+    # VSEARCH fails, samples are merged into temporary files first
+    output_fns = [output_fn, notmerged_fwd_fn, notmerged_rev_fn]
+    handles = [None if fn is None else micca.ioutils.open_output(fn, 'wb')
+               for fn in output_fns]
+    compressed = any(micca.ioutils.is_compressed_output(fn)
+                     for fn in output_fns if fn is not None)
+    try:
+        if (jobs > 1) or compressed:
+            _mergepairs_parallel(samples, handles, minovlen, maxdiffs,
+                                 nostagger, threads, jobs, output_dir)
+        else:
+            for input_fn, reverse_fn, sample_name in samples:
+                try:
+                    _mergepairs_sample(input_fn, reverse_fn, sample_name,
+                                       handles[0], handles[1], handles[2],
+                                       minovlen, maxdiffs, nostagger, threads,
+                                       output_dir)
+                except micca.tp.vsearch.VSEARCHError as err:
+                    warnings.warn("{}: VSEARCH error: {}, SKIP\n".format(
+                        os.path.basename(input_fn), err))
+    finally:
+        for handle in handles:
+            if handle is not None:
+                handle.close()
@@ -0,0 +1,84 @@
+##    Copyright 2015 Davide Albanese <davide.albanese@gmail.com>
+##    Copyright 2015 Fondazione Edmund Mach (FEM)
+
+##    This file is part of micca.
+##
+##    micca is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    micca is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with micca.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+import os.path
+
+import micca.ioutils
+import micca.seq
+import micca.tp
+from micca.api._trim import _trim_params
+
+
+# FASTA line width of the output file (as micca filter)
+_FASTA_WIDTH = 80
+
+
+def _preprocess_handle(input_handle, output_handle, sample_name, maxee_rate,
+                       maxns, minlen, trunclen):
+    """Filters the FASTQ reads read from the input handle (see
+    micca.seq.filter_records()) and writes them to the output handle in
+    FASTA format, with the sample name appended to the sequence
+    identifiers.
+    """
+
+    records = micca.seq.raw_records(input_handle, "fastq")
+    for title, seq, qual in micca.seq.filter_records(
+            records, maxee_rate, maxns, minlen, trunclen):
+        micca.seq.raw_write(output_handle,
+                            micca.seq.sample_title(title, sample_name), seq,
+                            fmt="fasta", wrap=_FASTA_WIDTH)
+
+
+def preprocess(input_fns, output_fn, forward=None, reverse=None,
+               maxerate=0.1, searchrc=False, duforward=False, dureverse=False,
+               maxee_rate=1, maxns=None, minlen=1, trunc=False, sep=".",
+               threads=1):
+
+    if trunc:
+        filter_minlen = 1
+        filter_trunclen = minlen
+    else:
+        filter_minlen = minlen
+        filter_trunclen = None
+
+    trim_params = _trim_params(forward, reverse, maxerate, searchrc,
+                               duforward, dureverse, "fastq", threads)
+
+    with micca.ioutils.open_output(output_fn, 'wb') as output_handle:
+        for input_fn in input_fns:
+            sample_name = micca.seq.file_sample_name(input_fn, sep)
+
+            def preprocess_handle(input_handle):
+                _preprocess_handle(input_handle, output_handle, sample_name,
+                                   maxee_rate, maxns, filter_minlen,
+                                   filter_trunclen)
+
+            # the trimmed reads are read from the cutadapt standard output
+            if trim_params:
+                input_fifo = micca.ioutils.InputFifo(
+                    input_fn, os.path.dirname(output_fn))
+                try:
+                    micca.tp.cutadapt_stream(input_fifo.name,
+                                             preprocess_handle, *trim_params)
+                finally:
+                    input_fifo.close()
+            else:
+                with micca.ioutils.open_input(input_fn, 'rU') as input_handle:
+                    preprocess_handle(input_handle)
@@ -18,7 +18,15 @@
 
 from __future__ import division
 
+import io
+import os
 import csv
+import gzip
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+from cStringIO import StringIO
 
 try:
     from itertools import izip_longest
@@ -27,65 +35,365 @@ except ImportError:
 
 from Bio import SeqIO
 
+import micca.seq
+import micca.ioutils
 
-def split(input_fn, output_fn, barcode_fn, notmatched_fn=None, counts_fn=None,
-          skip=0, maxe=1, trim=True, fmt="fastq"):
 
-    def hamming(seq1, seq2):
-        return sum(s1!=s2 for s1, s2 in izip_longest(seq1, seq2, fillvalue=""))
+# alphabet of the barcode variants stored in the index
+_INDEX_ALPHABET = "ACGTN"
 
-    # read barcodes
-    bc = dict()
-    for record in SeqIO.parse(barcode_fn, 'fasta'):
-        bc[record.id] = str(record.seq.upper())
+# maximum number of barcode variants stored in the index. Above this
+# limit reads are matched by computing the distances from all the barcodes
+_INDEX_MAXSIZE = 2000000
 
-    # barcode counter
-    bc_count = dict.fromkeys(bc.keys(), 0)
-    bc_count["Unknown"] = 0
+# size in bytes of the chunks processed in parallel
+_CHUNK_SIZE = 16*1024*1024
+
+# buffer size in bytes of the per-sample output files and of the copies
+_BUFFER_SIZE = 64*1024
+
+# compression level of the per-sample output files
+_GZIP_LEVEL = 6
+
+# barcode index of the worker processes (see _split_init())
+_worker_index = None
 
-    # write the output and notmatched files 
-    output_handle = open(output_fn,'wb')
-    for record in SeqIO.parse(input_fn, fmt):
-        seq = str(record.seq.upper())
 
-        # compute the number of errors for each barcode
-        bc_err = dict()
-        for sn, bc_seq in bc.iteritems():
-            end = skip+len(bc_seq)
-            e = hamming(bc_seq, seq[skip:end])
-            bc_err[sn] = e
+def _hamming(seq1, seq2):
+    return sum(s1!=s2 for s1, s2 in izip_longest(seq1, seq2, fillvalue=""))
 
-        # minimum error
-        mine = min(bc_err.values())
 
-        # if the minimum error is <= maximum allowed error, write to the merged
-        # file, else write to the notmatched file (if notmatched_fn is not None)
-        if mine <= maxe:
-            minsn = [sn for sn, e in bc_err.iteritems() if e == mine][0]
+def _barcode_variants(bc_seq, maxe):
+    """Yields the sequences at Hamming distance <= maxe from bc_seq
+    (substitutions with _INDEX_ALPHABET only) and their distances.
+    """
 
-            record.id = "{0};sample={1}".format(record.id, minsn)
+    for e in range(maxe+1):
+        for pos in itertools.combinations(range(len(bc_seq)), e):
+            subs = [[c for c in _INDEX_ALPHABET if c != bc_seq[p]]
+                    for p in pos]
+            for chars in itertools.product(*subs):
+                variant = list(bc_seq)
+                for p, c in zip(pos, chars):
+                    variant[p] = c
+                yield "".join(variant), e
 
+
+def _barcode_index_size(bc, maxe):
+    """Returns the number of variants that _barcode_index() would store
+    (upper bound).
+    """
+
+    nalt = len(_INDEX_ALPHABET) - 1
+    size = 0
+    for bc_seq in bc.itervalues():
+        n = len(bc_seq)
+        comb = 1
+        for e in range(min(maxe, n)+1):
+            size += comb * nalt**e
+            comb = comb * (n-e) // (e+1)
+    return size
+
+
+def _barcode_index(bc, maxe):
+    """Returns the barcode index, a dict barcode length -> dict variant ->
+    (distance, sample name), where the variants are all the sequences at
+    distance <= maxe from the barcodes of that length. The sample name is
+    None when the variant is at the same (minimum) distance from more than
+    one barcode (ambiguous). Returns None when the index would be larger
+    than _INDEX_MAXSIZE.
+    """
+
+    if _barcode_index_size(bc, maxe) > _INDEX_MAXSIZE:
+        return None
+
+    index = dict()
+    for sn, bc_seq in bc.iteritems():
+        variants = index.setdefault(len(bc_seq), dict())
+        values = [(e, sn) for e in range(maxe+1)]
+        for variant, e in _barcode_variants(bc_seq, maxe):
             try:
-                description = record.description.split(None, 1)[1]
-            except IndexError:
-                description = ""
-            record.description = description
-            
+                e_idx, sn_idx = variants[variant]
+            except KeyError:
+                variants[variant] = values[e]
+            else:
+                if e < e_idx:
+                    variants[variant] = values[e]
+                elif (e == e_idx) and (sn != sn_idx):
+                    variants[variant] = (e, None)
+    return index
+
+
+def _barcode_distances(seq, bc, skip, bc_len=None):
+    """Returns the list of (distance, sample name, barcode length) of the
+    sequence from all the barcodes (of length bc_len if not None).
+    """
+
+    return [(_hamming(bc_seq, seq[skip:skip+len(bc_seq)]), sn, len(bc_seq))
+            for sn, bc_seq in bc.iteritems()
+            if (bc_len is None) or (len(bc_seq) == bc_len)]
+
+
+def _barcode_match(seq, bc, index, skip, maxe):
+    """Returns the sample name and the length of the barcode matching the
+    (uppercase) sequence, (None, None) if no barcode is found within maxe
+    errors or if the best match is ambiguous. The barcode index (see
+    _barcode_index()) is probed once for each barcode length. The distances
+    from all the barcodes are computed when the index is None, when the
+    sequence is too short or when it contains characters not in
+    _INDEX_ALPHABET.
+    """
+
+    if index is None:
+        matches = _barcode_distances(seq, bc, skip)
+    else:
+        matches = []
+        for bc_len, variants in index.iteritems():
+            bc_seq = seq[skip:skip+bc_len]
+            if (len(bc_seq) == bc_len) and \
+               (not bc_seq.strip(_INDEX_ALPHABET)):
+                try:
+                    e, sn = variants[bc_seq]
+                except KeyError:
+                    continue
+                matches.append((e, sn, bc_len))
+            else:
+                matches.extend(_barcode_distances(seq, bc, skip, bc_len))
+
+    mine, minsn, minlen = maxe+1, None, None
+    for e, sn, bc_len in matches:
+        if e < mine:
+            mine, minsn, minlen = e, sn, bc_len
+        elif (e == mine) and (sn != minsn):
+            minsn = None
+
+    if minsn is None:
+        return None, None
+    return minsn, minlen
+
+
+def _gzip_open(fn, mode):
+    """Opens a buffered gzip-compressed output file.
+    """
+
+    return io.BufferedWriter(gzip.open(fn, mode, _GZIP_LEVEL), _BUFFER_SIZE)
+
+
+def _sample_fns(sample_dir, bc, fmt):
+    """Returns the dict sample name -> per-sample output file name.
+    """
+
+    return dict((sn, os.path.join(sample_dir, "{}.{}.gz".format(sn, fmt)))
+                for sn in bc)
+
+
+def _split_records(records, output_handle, notmatched_handle, sample_pool,
+                   sample_fns, bc, index, skip, maxe, trim, fmt):
+    """Demultiplexes the (title, sequence, quality) string tuples, writing
+    the matched records to output_handle (if not None) and/or to the
+    per-sample files sample_fns[sample name] (opened through the
+    micca.ioutils.OutputPool sample_pool, if not None), and the others to
+    notmatched_handle (if not None). Returns the barcode counts.
+    """
+
+    bc_count = dict.fromkeys(bc.keys(), 0)
+    bc_count["Unknown"] = 0
+
+    for title, seq, qual in records:
+        sn, bc_len = _barcode_match(seq.upper(), bc, index, skip, maxe)
+
+        # if a barcode is found within the maximum allowed error, write to
+        # the merged file, else write to the notmatched file (if
+        # notmatched_fn is not None)
+        if sn is not None:
             if trim:
-                record = record[end:]
-                
-            SeqIO.write(record, output_handle, fmt)
-            bc_count[minsn] += 1
+                seq = seq[skip+bc_len:]
+                if qual is not None:
+                    qual = qual[skip+bc_len:]
+
+            if sample_pool is not None:
+                micca.seq.raw_write(sample_pool.get(sample_fns[sn]), title,
+                                    seq, qual, fmt)
+
+            if output_handle is not None:
+                micca.seq.raw_write(output_handle,
+                                    micca.seq.sample_title(title, sn), seq,
+                                    qual, fmt)
+
+            bc_count[sn] += 1
+        else:
+            if notmatched_handle is not None:
+                micca.seq.raw_write(notmatched_handle, title, seq, qual, fmt)
+            bc_count["Unknown"] += 1
+
+    return bc_count
+
+
+def _split_init(bc, maxe):
+    """Builds the barcode index once in each worker process.
+    """
+
+    global _worker_index
+    _worker_index = _barcode_index(bc, maxe)
+
+
+def _split_chunk(args):
+    """Demultiplexes a chunk of the input file into the temporary output,
+    notmatched and per-sample files (pool worker). Returns the barcode
+    counts.
+    """
+
+    input_fn, start, end, output_fn, notmatched_fn, sample_dir, maxfiles, \
+        bc, skip, maxe, trim, fmt = args
+
+    with open(input_fn, 'rb') as input_handle:
+        input_handle.seek(start)
+        data = input_handle.read(end-start)
+    records = micca.seq.raw_records(StringIO(data), fmt)
+
+    output_handle, notmatched_handle, sample_pool, sample_fns = \
+        None, None, None, None
+    try:
+        if output_fn is not None:
+            output_handle = open(output_fn, 'wb')
+        if notmatched_fn is not None:
+            notmatched_handle = open(notmatched_fn, 'wb')
+        if sample_dir is not None:
+            sample_pool = micca.ioutils.OutputPool(_gzip_open, maxfiles)
+            sample_fns = _sample_fns(sample_dir, bc, fmt)
+        return _split_records(
+            records, output_handle, notmatched_handle, sample_pool,
+            sample_fns, bc, _worker_index, skip, maxe, trim, fmt)
+    finally:
+        for handle in [output_handle, notmatched_handle, sample_pool]:
+            if handle is not None:
+                handle.close()
+
+
+def _split_parallel(input_fn, output_handle, notmatched_handle, sample_dir,
+                    maxfiles, bc, skip, maxe, trim, fmt, threads, tmp_dir):
+    """Splits the input file in record-aligned chunks, demultiplexed in
+    parallel into temporary files. The temporary files are appended to the
+    output and notmatched handles (if not None) and to the per-sample files
+    in sample_dir (if not None) in the input order (concatenated gzip
+    files are valid gzip files). Returns the barcode counts.
+    """
+
+    if fmt == "fastq":
+        chunks = micca.seq.fastq_chunks(input_fn, _CHUNK_SIZE)
+    else:
+        chunks = micca.seq.fasta_chunks(input_fn, _CHUNK_SIZE)
+
+    def make_tempfiles(enabled):
+        if enabled:
+            return [micca.ioutils.make_tempfile(tmp_dir) for c in chunks]
+        else:
+            return [None for c in chunks]
+
+    output_tmp_fns = make_tempfiles(output_handle is not None)
+    notmatched_tmp_fns = make_tempfiles(notmatched_handle is not None)
+    if sample_dir is None:
+        sample_tmp_dirs = [None for c in chunks]
+    else:
+        sample_tmp_dirs = [tempfile.mkdtemp(prefix="tmp", dir=sample_dir)
+                           for c in chunks]
+        sample_fns = _sample_fns(sample_dir, bc, fmt)
+
+    args = [(input_fn, start, end, output_tmp_fn, notmatched_tmp_fn,
+             sample_tmp_dir, maxfiles, bc, skip, maxe, trim, fmt)
+            for (start, end), output_tmp_fn, notmatched_tmp_fn, sample_tmp_dir
+            in zip(chunks, output_tmp_fns, notmatched_tmp_fns,
+                   sample_tmp_dirs)]
+
+    bc_count = dict.fromkeys(bc.keys(), 0)
+    bc_count["Unknown"] = 0
+
+    def append(tmp_fn, handle):
+        with open(tmp_fn, 'rb') as tmp_handle:
+            shutil.copyfileobj(tmp_handle, handle, _BUFFER_SIZE)
+
+    pool = multiprocessing.Pool(threads, _split_init, (bc, maxe))
+    try:
+        for i, chunk_count in enumerate(pool.imap(_split_chunk, args)):
+            for sn, count in chunk_count.iteritems():
+                bc_count[sn] += count
+            if output_handle is not None:
+                append(output_tmp_fns[i], output_handle)
+            if notmatched_handle is not None:
+                append(notmatched_tmp_fns[i], notmatched_handle)
+            if sample_dir is not None:
+                chunk_sample_fns = _sample_fns(sample_tmp_dirs[i], bc, fmt)
+                for sn in sorted(bc):
+                    if chunk_count[sn] == 0:
+                        continue
+                    # first chunk of the sample: create the file
+                    mode = 'ab' if (bc_count[sn] > chunk_count[sn]) else 'wb'
+                    with open(sample_fns[sn], mode) as sample_handle:
+                        append(chunk_sample_fns[sn], sample_handle)
+                shutil.rmtree(sample_tmp_dirs[i])
+    finally:
+        pool.terminate()
+        pool.join()
+        for tmp_fn in output_tmp_fns + notmatched_tmp_fns:
+            if (tmp_fn is not None) and os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+        for tmp_dir in sample_tmp_dirs:
+            if (tmp_dir is not None) and os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    return bc_count
+
+
+def split(input_fn, output_fn, barcode_fn, notmatched_fn=None, counts_fn=None,
+          skip=0, maxe=1, trim=True, fmt="fastq", threads=1, sample_dir=None,
+          maxfiles=64):
+
+    if (output_fn is None) and (sample_dir is None):
+        raise ValueError("at least one between output_fn and sample_dir is "
+                         "required")
+
+    if (sample_dir is not None) and (not os.path.isdir(sample_dir)):
+        raise ValueError("directory {} does not exist".format(sample_dir))
+
+    if fmt not in ["fastq", "fasta"]:
+        raise ValueError("format {} not supported".format(fmt))
+
+    # read barcodes
+    bc = dict()
+    for record in SeqIO.parse(barcode_fn, 'fasta'):
+        bc[record.id] = str(record.seq.upper())
+
+    # write the output, notmatched and per-sample files
+    output_handle, notmatched_handle, sample_pool, sample_fns = \
+        None, None, None, None
+    try:
+        if output_fn is not None:
+            output_handle = micca.ioutils.open_output(output_fn, 'wb')
+            tmp_dir = os.path.dirname(output_fn)
         else:
-            if notmatched_fn is not None:
-                notmatched_handle = open(notmatched_fn,'ab')
-                SeqIO.write(record, notmatched_handle, fmt)
-                notmatched_handle.close()
-            bc_count['Unknown'] += 1
+            tmp_dir = sample_dir
+        if notmatched_fn is not None:
+            notmatched_handle = micca.ioutils.open_output(notmatched_fn, 'wb')
 
-    # END for record in SeqIO.parse(input_fn, fmt):
-            
-    output_handle.close()
+        # compressed files can not be split in chunks
+        if (threads > 1) and (micca.ioutils.compression(input_fn) is None):
+            bc_count = _split_parallel(
+                input_fn, output_handle, notmatched_handle, sample_dir,
+                maxfiles, bc, skip, maxe, trim, fmt, threads, tmp_dir)
+        else:
+            if sample_dir is not None:
+                sample_pool = micca.ioutils.OutputPool(_gzip_open, maxfiles)
+                sample_fns = _sample_fns(sample_dir, bc, fmt)
+            index = _barcode_index(bc, maxe)
+            with micca.ioutils.open_input(input_fn, 'rU') as input_handle:
+                records = micca.seq.raw_records(input_handle, fmt)
+                bc_count = _split_records(
+                    records, output_handle, notmatched_handle, sample_pool,
+                    sample_fns, bc, index, skip, maxe, trim, fmt)
+    finally:
+        for handle in [output_handle, notmatched_handle, sample_pool]:
+            if handle is not None:
+                handle.close()
 
     # write the sample counts file
     if counts_fn is not None:
@@ -100,4 +408,3 @@ def split(input_fn, output_fn, barcode_fn, notmatched_fn=None, counts_fn=None,
                 
             counts_writer.writerow(["Unknown", 
                                     "{:d}".format(bc_count["Unknown"])])
-            
@@ -18,8 +18,11 @@
 
 from __future__ import division
 
+import sys
 import os
 import os.path
+import itertools
+import multiprocessing
 
 import matplotlib
 matplotlib.use('Agg')
@@ -30,55 +33,192 @@ import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
+import micca.ioutils
+import micca.seq
+import micca.api._filterstats
 
-def _stats(input_fn, topn=None):
 
-    fastq_ascii=33
+# number of records processed at a time
+_BLOCK_SIZE = 4096
 
-    nseqs, nbases = 0, 0
-    len_count = np.array([], dtype=np.int, order='C')
-    qual_count = np.zeros(128, dtype=np.int, order='C')
-    qual_sum = np.array([], dtype=np.int, order='C')
-    eerate_sum = np.array([], dtype=np.float, order='C')
+# size in bytes of the chunks processed in parallel
+_CHUNK_SIZE = 16*1024*1024
 
-    with open(input_fn, "rU") as input_handle:
-        for title, seq, qualstr in FastqGeneralIterator(input_handle):
+_ACC_FN = "stats_acc.npz"
 
-            seqlen = len(seq)
-            if (seqlen < 1):
-                continue
 
-            nseqs += 1
-            nbases += seqlen
-            if seqlen > len_count.shape[0]:
-                len_count.resize(seqlen)
-                qual_sum.resize(seqlen)
-                eerate_sum.resize(seqlen)
+def _stats_update(acc, lens, qualint, mask, eerate):
+    """Updates the accumulators with a block of reads (see
+    micca.seq.qual_matrix() and micca.seq.eerate_matrix()).
+    """
 
-            # returns values in [0, 127]
-            qualint = np.fromstring(qualstr, dtype=np.int8)
+    maxlen = qualint.shape[1]
 
-            # phred quality
-            qual = qualint - fastq_ascii
+    acc["nseqs"] += lens.shape[0]
+    acc["nbases"] += lens.sum()
+    if maxlen > acc["len_count"].shape[0]:
+        acc["len_count"].resize(maxlen)
+        acc["qual_sum"].resize(maxlen)
+        acc["eerate_sum"].resize(maxlen)
 
-            # probability of error
-            pe = 10**(-qual / 10.)
+    acc["len_count"][:maxlen] += np.bincount(lens-1, minlength=maxlen)
+    acc["qual_count"] += np.bincount(qualint[mask], minlength=128)
 
-            # expected error
-            ee = np.cumsum(pe)
+    # phred quality
+    qual = np.where(mask, qualint.astype(np.int) - micca.seq.FASTQ_ASCII, 0)
+    acc["qual_sum"][:maxlen] += qual.sum(axis=0)
+    acc["eerate_sum"][:maxlen] += eerate.sum(axis=0)
 
-            # expected error rate %
-            eerate = (ee / np.arange(1, seqlen+1)) * 100
 
-            len_count[seqlen-1] += 1
-            qual_count += np.bincount(qualint, minlength=128)
+def _stats_acc():
+    """Returns empty accumulators.
+    """
 
-            qual_sum[:seqlen] += qual
-            eerate_sum[:seqlen] += eerate
+    return {
+        "nseqs": 0,
+        "nbases": 0,
+        "len_count": np.array([], dtype=np.int, order='C'),
+        "qual_count": np.zeros(128, dtype=np.int, order='C'),
+        "qual_sum": np.array([], dtype=np.int, order='C'),
+        "eerate_sum": np.array([], dtype=np.float, order='C')}
+
+
+def _stats_merge(acc, other):
+    """Adds the accumulators 'other' to 'acc'.
+    """
+
+    maxlen = other["len_count"].shape[0]
+    if maxlen > acc["len_count"].shape[0]:
+        acc["len_count"].resize(maxlen)
+        acc["qual_sum"].resize(maxlen)
+        acc["eerate_sum"].resize(maxlen)
+
+    acc["nseqs"] += other["nseqs"]
+    acc["nbases"] += other["nbases"]
+    acc["len_count"][:maxlen] += other["len_count"]
+    acc["qual_count"] += other["qual_count"]
+    acc["qual_sum"][:maxlen] += other["qual_sum"]
+    acc["eerate_sum"][:maxlen] += other["eerate_sum"]
+
+
+def _update(acc, facc, records, maxeerates, maxns):
+    """Updates the stats accumulators 'acc' and, if not None, the
+    filterstats accumulators 'facc' with a block of (sequence, quality)
+    string tuples (sequences must not be empty). The expected error rates
+    are computed once for both.
+    """
+
+    seqs = [seq for seq, qualstr in records]
+    lens, qualint, mask = micca.seq.qual_matrix(
+        [qualstr for seq, qualstr in records])
+    eerate = micca.seq.eerate_matrix(qualint, mask)
+
+    _stats_update(acc, lens, qualint, mask, eerate)
+    if facc is not None:
+        micca.api._filterstats._filterstats_update(
+            facc, seqs, lens, eerate, maxeerates, maxns)
+
+
+def _update_records(acc, facc, records, maxeerates, maxns):
+    """Updates the accumulators with a list of (title, sequence, quality)
+    string tuples, in blocks.
+    """
+
+    for i in range(0, len(records), _BLOCK_SIZE):
+        block = [(seq, qualstr) for title, seq, qualstr in
+                 records[i:i+_BLOCK_SIZE] if len(seq) > 0]
+        if block:
+            _update(acc, facc, block, maxeerates, maxns)
+
+
+def _stats_chunk(args):
+    """Returns the accumulators for a chunk of a FASTQ file (pool worker).
+    """
+
+    input_fn, start, end, filterstats, maxeerates, maxns = args
+
+    acc = _stats_acc()
+    if filterstats:
+        facc = micca.api._filterstats._filterstats_acc(maxeerates)
+    else:
+        facc = None
+
+    records = micca.seq.fastq_read_chunk(input_fn, start, end)
+    _update_records(acc, facc, records, maxeerates, maxns)
+    return acc, facc
+
+
+def _stats_acc_file(input_fn, topn=None, threads=1, filterstats=False,
+                    maxeerates=[0.25, 0.5, 0.75, 1, 1.25, 1.5], maxns=None,
+                    sample=None, seed=0):
+    """Returns the stats and, if filterstats is True, the filterstats
+    accumulators (None otherwise) for a FASTQ file, reading the file
+    once. When threads > 1 the file is split in chunks processed in
+    parallel (topn must be None and the file must not be compressed).
+    When sample is not None, only about 'sample' reads sampled at random
+    positions are processed (see micca.seq.fastq_sample()).
+    """
+
+    acc = _stats_acc()
+    if filterstats:
+        facc = micca.api._filterstats._filterstats_acc(maxeerates)
+    else:
+        facc = None
+
+    if sample is not None:
+        records = micca.seq.fastq_sample(input_fn, sample, seed=seed)
+        _update_records(acc, facc, records, maxeerates, maxns)
+        return acc, facc
+
+    # compressed files can not be split in chunks
+    if (threads > 1) and (topn is None) and \
+       (micca.ioutils.compression(input_fn) is None):
+        chunks = [(input_fn, start, end, filterstats, maxeerates, maxns)
+                  for start, end in
+                  micca.seq.fastq_chunks(input_fn, _CHUNK_SIZE)]
+        pool = multiprocessing.Pool(threads)
+        try:
+            for chunk_acc, chunk_facc in pool.imap(_stats_chunk, chunks):
+                _stats_merge(acc, chunk_acc)
+                if filterstats:
+                    micca.api._filterstats._filterstats_merge(
+                        facc, chunk_facc)
+        finally:
+            pool.terminate()
+            pool.join()
+        return acc, facc
+
+    with micca.ioutils.open_input(input_fn, "rU") as input_handle:
+        records = FastqGeneralIterator(input_handle)
+        while True:
+            block = list(itertools.islice(records, _BLOCK_SIZE))
+            if not block:
+                break
+
+            block = [(seq, qualstr) for title, seq, qualstr in block
+                     if len(seq) > 0]
+            if topn is not None:
+                block = block[:topn-acc["nseqs"]]
+            if block:
+                _update(acc, facc, block, maxeerates, maxns)
 
-            if (topn == nseqs):
+            if (topn == acc["nseqs"]):
                 break
 
+    return acc, facc
+
+
+def _stats_tables(acc):
+    """Returns the length distribution, the quality distribution and the
+    quality summary tables.
+    """
+
+    fastq_ascii = micca.seq.FASTQ_ASCII
+
+    nseqs, nbases = acc["nseqs"], acc["nbases"]
+    len_count, qual_count = acc["len_count"], acc["qual_count"]
+    qual_sum, eerate_sum = acc["qual_sum"], acc["eerate_sum"]
+
     if nseqs == 0:
         raise EOFError("no valid sequences in input file")
 
@@ -207,24 +347,50 @@ def _plot_qual_summ(values, output_fn):
     fig.savefig(output_fn, bbox_inches='tight', dpi=300, format='png')
 
 
-def stats(input_fn, output_dir, topn=None):
+def _stats_save(acc, output_fn):
+    """Writes the accumulators in a compressed .npz file.
+    """
 
-    if not os.path.isdir(output_dir):
-        raise ValueError("directory {} does not exist".format(output_dir))
+    with open(output_fn, 'wb') as output_handle:
+        np.savez_compressed(output_handle, **acc)
+
+
+def _stats_load(input_fn):
+    """Reads the accumulators from a .npz file written by _stats_save().
+    """
+
+    acc = _stats_acc()
+    try:
+        acc_file = np.load(input_fn)
+        for key in acc:
+            if isinstance(acc[key], np.ndarray):
+                acc[key] = acc_file[key].astype(acc[key].dtype)
+            else:
+                acc[key] = int(acc_file[key])
+        acc_file.close()
+    except (IOError, KeyError, ValueError):
+        raise ValueError("{}: invalid stats accumulator file".format(input_fn))
+
+    return acc
+
+
+def _write(acc, output_dir):
 
     len_dist_fn = os.path.join(output_dir, "stats_lendist.txt")
     qual_dist_fn = os.path.join(output_dir, "stats_qualdist.txt")
     qual_summ_fn = os.path.join(output_dir, "stats_qualsumm.txt")
+    acc_fn = os.path.join(output_dir, _ACC_FN)
 
     len_dist_plot_fn = os.path.join(output_dir, "stats_lendist_plot.png")
     qual_dist_plot_fn = os.path.join(output_dir, "stats_qualdist_plot.png")
     qual_summ_plot_fn = os.path.join(output_dir, "stats_qualsumm_plot.png")
 
-    len_dist, qual_dist, qual_summ = _stats(input_fn=input_fn, topn=topn)
+    len_dist, qual_dist, qual_summ = _stats_tables(acc)
 
     len_dist.to_csv(len_dist_fn, sep="\t", float_format="%.3f", index=False)
     qual_dist.to_csv(qual_dist_fn, sep="\t", float_format="%.3f", index=False)
     qual_summ.to_csv(qual_summ_fn, sep="\t", float_format="%.3f", index=False)
+    _stats_save(acc, acc_fn)
 
     # custom rc. "svg.fonttype: none" corrects the conversion of text in PDF
     # and SVG files
@@ -239,3 +405,45 @@ def stats(input_fn, output_dir, topn=None):
         _plot_len_dist(len_dist, len_dist_plot_fn)
         _plot_qual_dist(qual_dist, qual_dist_plot_fn)
         _plot_qual_summ(qual_summ, qual_summ_plot_fn)
+
+
+def stats(input_fn, output_dir, topn=None, threads=1, filterstats=False,
+          maxeerates=[0.25, 0.5, 0.75, 1, 1.25, 1.5], maxns=None,
+          sample=None, seed=0):
+
+    if not os.path.isdir(output_dir):
+        raise ValueError("directory {} does not exist".format(output_dir))
+
+    if (topn is not None) and (sample is not None):
+        raise ValueError("topn and sample are mutually exclusive")
+
+    acc, facc = _stats_acc_file(
+        input_fn=input_fn,
+        topn=topn,
+        threads=threads,
+        filterstats=filterstats,
+        maxeerates=maxeerates,
+        maxns=maxns,
+        sample=sample,
+        seed=seed)
+
+    if (sample is not None) and (acc["nseqs"] > 0):
+        sys.stdout.write(
+            "{:d} sampled reads, percentages are within +/-{:.2f}% of the "
+            "whole file values (95% confidence)\n".format(
+                acc["nseqs"], micca.seq.sample_pct_bound(acc["nseqs"])))
+
+    _write(acc, output_dir)
+    if filterstats:
+        micca.api._filterstats._write(facc, maxeerates, output_dir)
+
+
+def stats_combine(input_fns, output_dir):
+
+    if not os.path.isdir(output_dir):
+        raise ValueError("directory {} does not exist".format(output_dir))
+
+    acc = _stats_acc()
+    for input_fn in input_fns:
+        _stats_merge(acc, _stats_load(input_fn))
+    _write(acc, output_dir)
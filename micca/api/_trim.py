@@ -25,43 +25,58 @@ import micca.ioutils
 import micca.tp
 
 
+def _trim_params(forward, reverse, maxerate, searchrc, duforward, dureverse,
+                 fmt, threads):
+    """Returns the list of the cutadapt() keyword arguments of the trimming
+    passes: forward primers first, then reverse primers (passes without
+    primers are omitted).
+    """
+
+    params = []
+    if forward is not None:
+        params.append({
+            "front": forward,
+            "error_rate": maxerate,
+            "minimum_length": 1,
+            "discard_untrimmed": duforward,
+            "fmt": fmt,
+            "search_rc": searchrc,
+            "cores": threads})
+    if reverse is not None:
+        params.append({
+            "adapter": reverse,
+            "error_rate": maxerate,
+            "minimum_length": 1,
+            "discard_untrimmed": dureverse,
+            "fmt": fmt,
+            "search_rc": searchrc,
+            "cores": threads})
+    return params
+
+
 def trim(input_fn, output_fn, forward=None, reverse=None, maxerate=0.1,
-         searchrc=False, duforward=False, dureverse=False, fmt="fastq"):
+         searchrc=False, duforward=False, dureverse=False, fmt="fastq",
+         threads=1):
     
     if (forward is None) and (reverse is None):
         raise ValueError("at least one option between forward and reverse is "
                          "required")
 
-    output_dir = os.path.dirname(output_fn)
-  
-    output_tmp_fn = micca.ioutils.make_tempfile(output_dir)
-    try:
-        micca.tp.cutadapt(
-            input_fn=input_fn,
-            output_fn=output_tmp_fn,
-            front=forward,
-            error_rate=maxerate, 
-            minimum_length=1, 
-            discard_untrimmed=duforward,
-            fmt=fmt,
-            search_rc=searchrc)
-    except:
-        os.remove(output_tmp_fn)
-        raise
+    params = _trim_params(forward, reverse, maxerate, searchrc, duforward,
+                          dureverse, fmt, threads)
 
-    if os.stat(output_tmp_fn).st_size == 0:
-        os.rename(output_tmp_fn, output_fn)
-        return
-    
+    # a single pass when only one primer set is given, else the forward
+    # trimming output is piped into the reverse trimming
+    input_fifo = micca.ioutils.InputFifo(input_fn, os.path.dirname(output_fn))
     try:
-        micca.tp.cutadapt(
-            input_fn=output_tmp_fn,
-            output_fn=output_fn,
-            adapter=reverse,
-            error_rate=maxerate,
-            minimum_length=1, 
-            discard_untrimmed=dureverse,
-            fmt=fmt,
-            search_rc=searchrc)
+        if len(params) == 1:
+            micca.tp.cutadapt(input_fn=input_fifo.name, output_fn=output_fn,
+                              **params[0])
+        else:
+            micca.tp.cutadapt_pipe(
+                input_fn=input_fifo.name,
+                output_fn=output_fn,
+                first=params[0],
+                second=params[1])
     finally:
-        os.remove(output_tmp_fn)
+        input_fifo.close()
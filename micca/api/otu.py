@@ -23,7 +23,11 @@ import os.path
 import csv
 import re
 import sqlite3
+import shutil
+import inspect
+import functools
 
+import numpy as np
 import pandas as pd
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 
@@ -42,6 +46,54 @@ _OTUIDS_FN = "otuids.txt"
 _HITS_FN = "hits.txt"
 _OTUSCHIM_FN = "otuschim.fasta"
 
+# number of hits read at a time by _hits_to_otutable()
+_HITS_CHUNKSIZE = 1000000
+
+# sample name in the sequence labels
+_SAMPLE_RE = r'(?:^|;)sample=([^;]+)'
+
+# size annotation in the sequence labels
+_SIZE_RE = r'(^|;)size=([0-9]+)(;|$)'
+
+# number of records read at a time from .uc files
+_UC_CHUNKSIZE = 1000000
+
+# approximate memory used by the in-memory index of the dereplication .uc
+# file in denovo_swarm(), relative to the size of the file
+_UC_INDEX_MEMORY_RATIO = 3
+
+# buffer size in bytes of the decompression of the input files
+_BUFFER_SIZE = 1024*1024
+
+
+def _decompress_input(func):
+    """Decorator of the OTU picking functions. VSEARCH reads the input file
+    more than once: if the input file (input_fn) is compressed, it is
+    decompressed into a temporary file in the output directory
+    (output_dir), removed when the function returns.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        callargs = inspect.getcallargs(func, *args, **kwargs)
+        input_fn, output_dir = callargs["input_fn"], callargs["output_dir"]
+        if (micca.ioutils.compression(input_fn) is None) or \
+           (not os.path.isdir(output_dir)):
+            return func(**callargs)
+
+        input_tmp_fn = micca.ioutils.make_tempfile(output_dir)
+        try:
+            with micca.ioutils.open_input(input_fn, 'rb') as input_handle, \
+                 open(input_tmp_fn, 'wb') as input_tmp_handle:
+                shutil.copyfileobj(input_handle, input_tmp_handle,
+                                   _BUFFER_SIZE)
+            callargs["input_fn"] = input_tmp_fn
+            return func(**callargs)
+        finally:
+            os.remove(input_tmp_fn)
+
+    return wrapper
+
 
 def _rename_seqids(input_fn, otuids_fn, prefix=""):
     output_dir = os.path.dirname(input_fn)
@@ -65,60 +117,338 @@ def _rename_seqids(input_fn, otuids_fn, prefix=""):
 
 
 def _hits_to_otutable(hits_fn, otuids_fn, otutable_fn):
+    """Builds the OTU table from the hits file. The hits are read in chunks,
+    sample names and OTUs are converted to integer codes and counted with
+    numpy.bincount(). All the OTUs in otuids_fn are reported (in the same
+    order), samples are sorted by name.
+    """
 
     with open(otuids_fn, 'rU') as otuids_handle:
         otuids_reader = csv.reader(otuids_handle, delimiter='\t')
-        otuids = [(row[1], row[0]) for row in otuids_reader]
-    ordered_otuids = [otuid[1] for otuid in otuids]
-    otuids_dict = dict(otuids)
-
-    otutable_dict = {}
-    with open(hits_fn, 'rU') as hits_handle:
-        hits_reader = csv.reader(hits_handle, delimiter='\t')
-        for row in hits_reader:
-            match = re.search("(^|;)sample=([^;]+)", row[0])
-            if match:
-                sample_name = match.group(2)
-            else:
-                sample_name = "noname"
-            sample = otutable_dict.setdefault(sample_name, dict())
-            otuid = otuids_dict[row[1]]
-            sample.setdefault(otuid, 0)
-            sample[otuid] += 1
-
-    otutable = pd.DataFrame.from_dict(otutable_dict)
-    otutable.fillna(0, inplace=True)
-    otutable = otutable.astype(int)
-    otutable = otutable.loc[ordered_otuids]
+        otuids = [(row[0], row[1]) for row in otuids_reader]
+    ordered_otuids = pd.Index([otuid for otuid, seqid in otuids], name="OTU")
+    seqids = pd.Index([seqid for otuid, seqid in otuids])
+    notus = len(otuids)
+
+    samples = pd.Index([], dtype=object)
+    counts = np.zeros((0, notus), dtype=np.int64)
+    if os.stat(hits_fn).st_size > 0:
+        hits_reader = pd.read_csv(
+            hits_fn, sep='\t', header=None, usecols=[0, 1], dtype=str,
+            na_filter=False, quoting=csv.QUOTE_NONE,
+            chunksize=_HITS_CHUNKSIZE)
+        for hits in hits_reader:
+            otu_codes = seqids.get_indexer(hits[1])
+            unknown = (otu_codes < 0)
+            if unknown.any():
+                raise KeyError(hits[1][unknown].iloc[0])
+
+            sample_names = hits[0].str.extract(
+                _SAMPLE_RE, expand=False).fillna("noname")
+            codes, names = pd.factorize(sample_names)
+            samples = samples.append(names.difference(samples))
+            sample_codes = samples.get_indexer(names)[codes]
+
+            chunk_counts = np.bincount(
+                sample_codes * notus + otu_codes,
+                minlength=len(samples) * notus).reshape(len(samples), notus)
+            chunk_counts[:counts.shape[0]] += counts
+            counts = chunk_counts
+
+    order = samples.argsort()
+    otutable = pd.DataFrame(counts[order].T, index=ordered_otuids,
+                            columns=samples[order])
     otutable.to_csv(otutable_fn, sep='\t', index_label="OTU")
 
 
+def _otutabout_read(otutabout_fn, otuids_fn):
+    """Reads the OTU table written by VSEARCH (--otutabout), renaming the
+    OTUs as in otuids_fn (see _rename_seqids()). VSEARCH truncates the OTU
+    ids at the first ';': returns None if the truncated ids are not unique
+    (e.g. 1;sample=A and 1;sample=B), the table must then be built from the
+    hits file (see _hits_to_otutable()).
+    """
+
+    newids = dict()
+    with open(otuids_fn, 'rU') as otuids_handle:
+        otuids_reader = csv.reader(otuids_handle, delimiter='\t')
+        for row in otuids_reader:
+            seqid = row[1].split(';')[0]
+            if seqid in newids:
+                return None
+            newids[seqid] = row[0]
+
+    # no OTUs
+    if os.stat(otutabout_fn).st_size == 0:
+        return pd.DataFrame(dtype=np.int64)
+
+    # index_col would convert numeric OTU ids
+    otutable = pd.read_csv(otutabout_fn, sep='\t', dtype=str,
+                           na_filter=False, quoting=csv.QUOTE_NONE)
+    otutable = otutable.set_index(otutable.columns[0])
+    # taxonomy column, added when the OTU labels contain 'tax='
+    if (otutable.shape[1] > 0) and (otutable.columns[-1] == "taxonomy"):
+        otutable = otutable.iloc[:, :-1]
+    otutable.index = [newids[otuid] for otuid in otutable.index]
+    return otutable.astype(np.int64)
+
+
+def _otutabout_to_otutable(otutables, otuids_fn, otutable_fn):
+    """Writes the OTU table concatenating the rows of the tables read by
+    _otutabout_read(). All the OTUs in otuids_fn are reported (in the same
+    order), samples are sorted by name.
+    """
+
+    with open(otuids_fn, 'rU') as otuids_handle:
+        otuids_reader = csv.reader(otuids_handle, delimiter='\t')
+        ordered_otuids = pd.Index([row[0] for row in otuids_reader],
+                                  name="OTU")
+
+    otutable = pd.concat(otutables, axis=0, sort=True)
+    otutable = otutable.fillna(0).astype(np.int64)
+    otutable = otutable.reindex(index=ordered_otuids, fill_value=0)
+    otutable = otutable.sort_index(axis=1)
+    otutable.to_csv(otutable_fn, sep='\t', index_label="OTU")
+
+
+def _write_otutable(hits_fn, otuids_fn, otutable_fn, otutabout_fn=None):
+    """Writes the OTU table from the hits file or, if otutabout_fn is not
+    None, from the OTU table written by VSEARCH (see _otutabout_read()).
+    """
+
+    otutable = None
+    if otutabout_fn is not None:
+        otutable = _otutabout_read(otutabout_fn, otuids_fn)
+
+    if otutable is None:
+        _hits_to_otutable(hits_fn, otuids_fn, otutable_fn)
+    else:
+        _otutabout_to_otutable([otutable], otuids_fn, otutable_fn)
+
+
+def _strip_size(s):
+    return re.sub(_SIZE_RE, '', s)
+
+
+def _available_memory():
+    """Returns the available memory in bytes (MemAvailable in /proc/meminfo),
+    None if unknown.
+    """
+
+    try:
+        with open("/proc/meminfo", 'rU') as meminfo_handle:
+            for line in meminfo_handle:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _uc_hits(uc_fn):
+    """Reads the .uc file in chunks. Yields the (queries, targets) arrays of
+    the hits (H records) and of the centroids (C records, hits of
+    themselves).
+    """
+
+    if os.stat(uc_fn).st_size == 0:
+        return
+
+    uc_reader = pd.read_csv(
+        uc_fn, sep='\t', header=None, usecols=[0, 8, 9], dtype=str,
+        na_filter=False, quoting=csv.QUOTE_NONE, chunksize=_UC_CHUNKSIZE)
+    for uc in uc_reader:
+        uc = uc[uc[0].isin(['H', 'C'])]
+        queries = uc[8].values
+        targets = np.where(uc[0].values == 'C', queries, uc[9].values)
+        yield queries, targets
+
+
+def _uc_to_index(uc_fn):
+    """Returns the grouped (CSR-style) index of the .uc file hits
+    (targets, offsets, queries): the queries of the target targets[i]
+    (pandas Index) are queries[offsets[i]:offsets[i+1]], in file order.
+    """
+
+    targets = pd.Index([], dtype=object)
+    codes_list, queries_list = [], []
+    for queries, chunk_targets in _uc_hits(uc_fn):
+        codes, names = pd.factorize(chunk_targets)
+        names = pd.Index(names)
+        targets = targets.append(names.difference(targets))
+        codes_list.append(targets.get_indexer(names)[codes])
+        queries_list.append(queries)
+
+    if not codes_list:
+        return targets, np.zeros(1, dtype=np.int64), np.array([], dtype=object)
+
+    codes = np.concatenate(codes_list)
+    queries = np.concatenate(queries_list)
+    offsets = np.zeros(len(targets)+1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=len(targets)), out=offsets[1:])
+    # stable sort, the queries of each target are kept in file order
+    return targets, offsets, queries[np.argsort(codes, kind="mergesort")]
+
+
 def _uc_to_hitssqlite(uc_fn, sqlite_fn):
     con = sqlite3.connect(sqlite_fn)
-    cur = con.cursor()
-    cur.execute('CREATE TABLE hits (query text, target text, ident real)')
-
-    with open(uc_fn, 'rU') as uc_handle:
-        uc_reader = csv.reader(uc_handle, delimiter='\t')
-        for row in uc_reader:
-            rtype, ident, query, target = row[0], row[3], row[8], row[9]
-            if rtype == 'H':
-                hit = (query, target, ident)
-            elif rtype == 'C':
-                hit = (query, query, 100.0)
-            else:
-                continue
-            cur.execute('INSERT INTO hits VALUES (?, ?, ?)', hit)
-
-    cur.execute('CREATE INDEX idx_target ON hits (target)')
-    con.commit()
-    cur.close()
+    con.text_factory = str
+
+    # single transaction
+    with con:
+        con.execute('CREATE TABLE hits (query text, target text)')
+        for queries, targets in _uc_hits(uc_fn):
+            con.executemany('INSERT INTO hits VALUES (?, ?)',
+                            zip(queries, targets))
+        con.execute('CREATE INDEX idx_target ON hits (target)')
     con.close()
 
 
+def _swarm_members(swarms_fn, otuids):
+    """Yields the (amplicon, otuid) pairs of the swarm OTUs (swarm output
+    file) in otuids (set).
+    """
+
+    with open(swarms_fn, 'rU') as swarms_handle:
+        swarms_reader = csv.reader(swarms_handle, delimiter=' ')
+        for otu in swarms_reader:
+            otuid = _strip_size(otu[0])
+            if otuid in otuids:
+                for derep in otu:
+                    yield _strip_size(derep), otuid
+
+
+def _swarm_hits_index(swarms_fn, otuids, uc_fn):
+    """Yields the hits (read, otuid) of the reads to the swarm OTUs using
+    the in-memory index of the dereplication .uc file (see _uc_to_index()).
+    """
+
+    targets, offsets, queries = _uc_to_index(uc_fn)
+    for derep, otuid in _swarm_members(swarms_fn, otuids):
+        try:
+            i = targets.get_loc(derep)
+        except KeyError:
+            continue
+        for query in queries[offsets[i]:offsets[i+1]]:
+            yield query, otuid
+
+
+def _swarm_hits_sqlite(swarms_fn, otuids, uc_fn, sqlite_fn):
+    """Yields the hits (read, otuid) of the reads to the swarm OTUs joining
+    the dereplication .uc file and the swarm OTUs in a SQLite database
+    (sqlite_fn), when the in-memory index does not fit in memory.
+    """
+
+    _uc_to_hitssqlite(uc_fn, sqlite_fn)
+    con = sqlite3.connect(sqlite_fn)
+    con.text_factory = str
+    try:
+        with con:
+            con.execute('CREATE TABLE swarms (derep text, otuid text)')
+            con.executemany('INSERT INTO swarms VALUES (?, ?)',
+                            _swarm_members(swarms_fn, otuids))
+
+        cur = con.execute(
+            'SELECT hits.query, swarms.otuid FROM swarms '
+            'JOIN hits ON hits.target = swarms.derep '
+            'ORDER BY swarms.rowid, hits.rowid')
+        for query, otuid in cur:
+            yield query, otuid
+    finally:
+        con.close()
+
+
+def _expand_hits(derep_hits_fn, index, hits_fn):
+    """Expands the hits of the dereplicated sequences (derep_hits_fn,
+    query+target+id) to the reads, using the grouped index of the
+    dereplication .uc file (see _uc_to_index()).
+    """
+
+    targets, offsets, queries = index
+    with open(hits_fn, 'wb') as hits_handle:
+        if os.stat(derep_hits_fn).st_size == 0:
+            return
+
+        hits_reader = pd.read_csv(
+            derep_hits_fn, sep='\t', header=None, dtype=str,
+            na_filter=False, quoting=csv.QUOTE_NONE,
+            chunksize=_HITS_CHUNKSIZE)
+        for hits in hits_reader:
+            derep_ids = hits[0].str.replace(_SIZE_RE, '', regex=True)
+            codes = targets.get_indexer(derep_ids)
+            unknown = (codes < 0)
+            if unknown.any():
+                raise KeyError(derep_ids[unknown].iloc[0])
+
+            # positions of the reads of each hit in queries
+            counts = offsets[codes+1] - offsets[codes]
+            starts = np.repeat(offsets[codes] - np.cumsum(counts) + counts,
+                               counts)
+            reads = queries[starts + np.arange(counts.sum())]
+
+            hits_handle.writelines(
+                "{}\t{}\t{}\n".format(*hit) for hit in zip(
+                    reads, np.repeat(hits[1].values, counts),
+                    np.repeat(hits[2].values, counts)))
+
+
+def _expand_notmatched(derep_notmatched_fn, index, input_fn, notmatched_fn):
+    """Writes the reads of input_fn corresponding to the dereplicated
+    sequences in derep_notmatched_fn, reading input_fn sequentially.
+    """
+
+    targets, offsets, queries = index
+    reads = set()
+    with open(derep_notmatched_fn, 'rU') as derep_notmatched_handle:
+        for title, seq in SimpleFastaParser(derep_notmatched_handle):
+            i = targets.get_loc(_strip_size(title.split()[0]))
+            reads.update(queries[offsets[i]:offsets[i+1]])
+
+    with open(input_fn, 'rU') as input_handle:
+        with open(notmatched_fn, 'wb') as notmatched_handle:
+            for title, seq in SimpleFastaParser(input_handle):
+                if title.split()[0] in reads:
+                    notmatched_handle.write(">{}\n{}\n".format(title, seq))
+
+
+def _derep_usearch_global(input_fn, derep_fn, derep_uc_fn, hits_fn,
+                          notmatched_fn=None, **kwargs):
+    """Maps the dereplicated sequences (derep_fn, with size annotations)
+    instead of the reads of input_fn with micca.tp.vsearch.usearch_global()
+    (query+target+id user fields) and expands the hits to the reads using
+    the dereplication .uc file (derep_uc_fn). If notmatched_fn is not None,
+    the reads not matched are written in notmatched_fn.
+    """
+
+    output_dir = os.path.dirname(hits_fn)
+    derep_hits_fn = micca.ioutils.make_tempfile(output_dir)
+    derep_notmatched_fn = None
+    if notmatched_fn is not None:
+        derep_notmatched_fn = micca.ioutils.make_tempfile(output_dir)
+
+    try:
+        micca.tp.vsearch.usearch_global(
+            input_fn=derep_fn,
+            userout_fn=derep_hits_fn,
+            userfields="query+target+id",
+            notmatched_fn=derep_notmatched_fn,
+            **kwargs)
+
+        index = _uc_to_index(derep_uc_fn)
+        _expand_hits(derep_hits_fn, index, hits_fn)
+        if notmatched_fn is not None:
+            _expand_notmatched(derep_notmatched_fn, index, input_fn,
+                               notmatched_fn)
+    finally:
+        os.remove(derep_hits_fn)
+        if derep_notmatched_fn is not None:
+            os.remove(derep_notmatched_fn)
+
+
 def _denovo_greedy(input_fn, otus_fn, otuids_fn, hits_fn, otuschim_fn,
                    otutable_fn=None, ident=0.97, threads=1, greedy="dgc",
-                   minsize=2, rmchim=False, chim_abskew=2.0):
+                   minsize=2, rmchim=False, chim_abskew=2.0,
+                   otutabout_fn=None, derep_mapping=False):
 
     if greedy == "dgc":
         maxaccepts = 1
@@ -131,267 +461,403 @@ def _denovo_greedy(input_fn, otus_fn, otuids_fn, hits_fn, otuschim_fn,
 
     output_dir = os.path.dirname(otus_fn)
 
-    # dereplication
+    # dereplication. When derep_mapping is True, the dereplicated sequences
+    # are kept for the mapping step
     derep_fn = micca.ioutils.make_tempfile(output_dir)
+    derep_uc_fn = None
+    if derep_mapping:
+        derep_uc_fn = micca.ioutils.make_tempfile(output_dir)
     try:
-        micca.tp.vsearch.derep_fulllength(input_fn, derep_fn, sizeout=True)
-    except:
-        os.remove(derep_fn)
-        raise
-
-    if os.stat(derep_fn).st_size == 0:
-        os.remove(derep_fn)
-        return
+        micca.tp.vsearch.derep_fulllength(input_fn, derep_fn, derep_uc_fn,
+                                          sizeout=True)
 
-    # sort by size and filter by minimum size
-    derep_sort_fn = micca.ioutils.make_tempfile(output_dir)
-    try:
-        micca.tp.vsearch.sortbysize(derep_fn, derep_sort_fn, minsize=minsize)
-    except:
-        os.remove(derep_sort_fn)
-        raise
-    finally:
-        os.remove(derep_fn)
+        if os.stat(derep_fn).st_size == 0:
+            return
 
-    if os.stat(derep_sort_fn).st_size == 0:
-        os.remove(derep_sort_fn)
-        return
+        # sort by size and filter by minimum size
+        derep_sort_fn = micca.ioutils.make_tempfile(output_dir)
+        try:
+            micca.tp.vsearch.sortbysize(derep_fn, derep_sort_fn,
+                                        minsize=minsize)
+        except:
+            os.remove(derep_sort_fn)
+            raise
 
-    # greedy clustering
-    otus_temp_fn = micca.ioutils.make_tempfile(output_dir)
-    try:
-        micca.tp.vsearch.cluster_smallmem(
-            input_fn=derep_sort_fn,
-            centroids_fn=otus_temp_fn,
-            ident=ident,
-            threads=threads,
-            maxaccepts=maxaccepts,
-            maxrejects=32,
-            sizeorder=sizeorder,
-            usersort=True,
-            sizein=True,
-            sizeout=rmchim,
-            xsize=not rmchim)
-    except:
-        os.remove(otus_temp_fn)
-        raise
-    finally:
-        os.remove(derep_sort_fn)
+        if os.stat(derep_sort_fn).st_size == 0:
+            os.remove(derep_sort_fn)
+            return
 
-    # remove chimeras
-    if rmchim:
-        otus_nochim_fn = micca.ioutils.make_tempfile(output_dir)
+        # greedy clustering
+        otus_temp_fn = micca.ioutils.make_tempfile(output_dir)
         try:
-            micca.tp.vsearch.uchime_denovo(
-                input_fn=otus_temp_fn,
-                chimeras_fn=otuschim_fn,
-                nonchimeras_fn=otus_nochim_fn,
-                xsize=True,
-                abskew=chim_abskew)
+            micca.tp.vsearch.cluster_smallmem(
+                input_fn=derep_sort_fn,
+                centroids_fn=otus_temp_fn,
+                ident=ident,
+                threads=threads,
+                maxaccepts=maxaccepts,
+                maxrejects=32,
+                sizeorder=sizeorder,
+                usersort=True,
+                sizein=True,
+                sizeout=rmchim,
+                xsize=not rmchim)
         except:
-            os.remove(otus_nochim_fn)
+            os.remove(otus_temp_fn)
             raise
         finally:
-            os.remove(otus_temp_fn)
-
-        if os.stat(otus_nochim_fn).st_size == 0:
+            os.remove(derep_sort_fn)
+
+        # remove chimeras
+        if rmchim:
+            otus_nochim_fn = micca.ioutils.make_tempfile(output_dir)
+            try:
+                micca.tp.vsearch.uchime_denovo(
+                    input_fn=otus_temp_fn,
+                    chimeras_fn=otuschim_fn,
+                    nonchimeras_fn=otus_nochim_fn,
+                    xsize=True,
+                    abskew=chim_abskew)
+            except:
+                os.remove(otus_nochim_fn)
+                raise
+            finally:
+                os.remove(otus_temp_fn)
+
+            if os.stat(otus_nochim_fn).st_size == 0:
+                os.remove(otus_nochim_fn)
+                return
+        else:
+            otus_nochim_fn = otus_temp_fn
+
+        # map sequences to the representatives
+        try:
+            if derep_mapping:
+                _derep_usearch_global(
+                    input_fn=input_fn,
+                    derep_fn=derep_fn,
+                    derep_uc_fn=derep_uc_fn,
+                    hits_fn=hits_fn,
+                    db_fn=otus_nochim_fn,
+                    ident=0.97,
+                    threads=threads,
+                    dbmatched_fn=otus_fn)
+            else:
+                micca.tp.vsearch.usearch_global(
+                    input_fn=input_fn,
+                    db_fn=otus_nochim_fn,
+                    userout_fn=hits_fn,
+                    ident=0.97,
+                    threads=threads,
+                    userfields="query+target+id",
+                    dbmatched_fn=otus_fn,
+                    otutabout_fn=otutabout_fn)
+        finally:
             os.remove(otus_nochim_fn)
-            return
-    else:
-        otus_nochim_fn = otus_temp_fn
-
-    # map sequences to the representatives
-    try:
-        micca.tp.vsearch.usearch_global(
-            input_fn=input_fn,
-            db_fn=otus_nochim_fn,
-            userout_fn=hits_fn,
-            ident=0.97,
-            threads=threads,
-            userfields="query+target+id",
-            dbmatched_fn=otus_fn)
     finally:
-        os.remove(otus_nochim_fn)
+        os.remove(derep_fn)
+        if derep_uc_fn is not None:
+            os.remove(derep_uc_fn)
 
     _rename_seqids(otus_fn, otuids_fn, prefix="DENOVO")
 
     if otutable_fn is not None:
-        _hits_to_otutable(hits_fn, otuids_fn, otutable_fn)
+        _write_otutable(hits_fn, otuids_fn, otutable_fn, otutabout_fn)
 
 
-def denovo_unoise(input_fn, output_dir, threads=1, minsize=8, unoise_alpha=2.0,
-                  rmchim=False, chim_abskew=16.0):
-
-    if not os.path.isdir(output_dir):
-        raise ValueError("directory {} does not exist".format(output_dir))
+def _denovo_unoise(input_fn, otus_fn, otuids_fn, hits_fn, otuschim_fn,
+                   otutable_fn=None, threads=1, minsize=8, unoise_alpha=2.0,
+                   rmchim=False, chim_abskew=16.0, otutabout_fn=None,
+                   derep_mapping=False):
 
-    otus_fn = os.path.join(output_dir, _OTUS_FN)
-    otuids_fn = os.path.join(output_dir, _OTUIDS_FN)
-    hits_fn = os.path.join(output_dir, _HITS_FN)
-    otuschim_fn = os.path.join(output_dir, _OTUSCHIM_FN)
-    otutable_fn = os.path.join(output_dir, _OTUTABLE_FN)
+    output_dir = os.path.dirname(otus_fn)
 
-    # dereplication
+    # dereplication. When derep_mapping is True, the dereplicated sequences
+    # are kept for the mapping step
     derep_fn = micca.ioutils.make_tempfile(output_dir)
+    derep_uc_fn = None
+    if derep_mapping:
+        derep_uc_fn = micca.ioutils.make_tempfile(output_dir)
     try:
-        micca.tp.vsearch.derep_fulllength(input_fn, derep_fn, sizeout=True)
-    except:
-        os.remove(derep_fn)
-        raise
-
-    if os.stat(derep_fn).st_size == 0:
-        os.remove(derep_fn)
-        return
+        micca.tp.vsearch.derep_fulllength(input_fn, derep_fn, derep_uc_fn,
+                                          sizeout=True)
 
-    # unoise
-    otus_temp_fn = micca.ioutils.make_tempfile(output_dir)
-    try:
-        micca.tp.vsearch.cluster_unoise(
-            input_fn=derep_fn,
-            centroids_fn=otus_temp_fn,
-            minsize=minsize,
-            unoise_alpha=unoise_alpha,
-            maxaccepts=1,
-            maxrejects=32,
-            sizeorder=False,
-            usersort=True,
-            sizein=True,
-            sizeout=rmchim,
-            xsize=not rmchim,
-            threads=threads)
-    except:
-        os.remove(otus_temp_fn)
-        raise
-    finally:
-        os.remove(derep_fn)
+        if os.stat(derep_fn).st_size == 0:
+            return
 
-    # remove chimeras
-    if rmchim:
-        otus_nochim_fn = micca.ioutils.make_tempfile(output_dir)
+        # unoise
+        otus_temp_fn = micca.ioutils.make_tempfile(output_dir)
         try:
-            micca.tp.vsearch.uchime3_denovo(
-                input_fn=otus_temp_fn,
-                chimeras_fn=otuschim_fn,
-                nonchimeras_fn=otus_nochim_fn,
-                abskew=chim_abskew,
-                xsize=True)
+            micca.tp.vsearch.cluster_unoise(
+                input_fn=derep_fn,
+                centroids_fn=otus_temp_fn,
+                minsize=minsize,
+                unoise_alpha=unoise_alpha,
+                maxaccepts=1,
+                maxrejects=32,
+                sizeorder=False,
+                usersort=True,
+                sizein=True,
+                sizeout=rmchim,
+                xsize=not rmchim,
+                threads=threads)
         except:
-            os.remove(otus_nochim_fn)
-            raise
-        finally:
             os.remove(otus_temp_fn)
+            raise
 
-        if os.stat(otus_nochim_fn).st_size == 0:
+        # remove chimeras
+        if rmchim:
+            otus_nochim_fn = micca.ioutils.make_tempfile(output_dir)
+            try:
+                micca.tp.vsearch.uchime3_denovo(
+                    input_fn=otus_temp_fn,
+                    chimeras_fn=otuschim_fn,
+                    nonchimeras_fn=otus_nochim_fn,
+                    abskew=chim_abskew,
+                    xsize=True)
+            except:
+                os.remove(otus_nochim_fn)
+                raise
+            finally:
+                os.remove(otus_temp_fn)
+
+            if os.stat(otus_nochim_fn).st_size == 0:
+                os.remove(otus_nochim_fn)
+                return
+        else:
+            otus_nochim_fn = otus_temp_fn
+
+        # map sequences to the representatives
+        try:
+            if derep_mapping:
+                _derep_usearch_global(
+                    input_fn=input_fn,
+                    derep_fn=derep_fn,
+                    derep_uc_fn=derep_uc_fn,
+                    hits_fn=hits_fn,
+                    db_fn=otus_nochim_fn,
+                    ident=0.97,
+                    threads=threads,
+                    dbmatched_fn=otus_fn)
+            else:
+                micca.tp.vsearch.usearch_global(
+                    input_fn=input_fn,
+                    db_fn=otus_nochim_fn,
+                    userout_fn=hits_fn,
+                    ident=0.97,
+                    threads=threads,
+                    userfields="query+target+id",
+                    dbmatched_fn=otus_fn,
+                    otutabout_fn=otutabout_fn)
+        finally:
             os.remove(otus_nochim_fn)
-            return
-    else:
-        otus_nochim_fn = otus_temp_fn
-
-    # map sequences to the representatives
-    try:
-        micca.tp.vsearch.usearch_global(
-            input_fn=input_fn,
-            db_fn=otus_nochim_fn,
-            userout_fn=hits_fn,
-            ident=0.97,
-            threads=threads,
-            userfields="query+target+id",
-            dbmatched_fn=otus_fn)
     finally:
-        os.remove(otus_nochim_fn)
+        os.remove(derep_fn)
+        if derep_uc_fn is not None:
+            os.remove(derep_uc_fn)
 
     _rename_seqids(otus_fn, otuids_fn, prefix="DENOVO")
 
     if otutable_fn is not None:
-        _hits_to_otutable(hits_fn, otuids_fn, otutable_fn)
+        _write_otutable(hits_fn, otuids_fn, otutable_fn, otutabout_fn)
 
 
 def _closed_ref(input_fn, ref_fn, otus_fn, otuids_fn, hits_fn,
                 notmatched_fn=None, otutable_fn=None, ident=0.97, threads=1,
-                mincov=0.75, strand="both"):
-
-    micca.tp.vsearch.usearch_global(
-        input_fn=input_fn,
-        db_fn=ref_fn,
-        userout_fn=hits_fn,
-        ident=ident,
-        threads=threads,
-        userfields="query+target+id",
-        query_cov=mincov,
-        dbmatched_fn=otus_fn,
-        notmatched_fn=notmatched_fn,
-        strand=strand)
+                mincov=0.75, strand="both", otutabout_fn=None,
+                derep_mapping=False):
+
+    if derep_mapping:
+        output_dir = os.path.dirname(otus_fn)
+        derep_fn = micca.ioutils.make_tempfile(output_dir)
+        derep_uc_fn = micca.ioutils.make_tempfile(output_dir)
+        try:
+            micca.tp.vsearch.derep_fulllength(input_fn, derep_fn, derep_uc_fn,
+                                              sizeout=True)
+            _derep_usearch_global(
+                input_fn=input_fn,
+                derep_fn=derep_fn,
+                derep_uc_fn=derep_uc_fn,
+                hits_fn=hits_fn,
+                notmatched_fn=notmatched_fn,
+                db_fn=ref_fn,
+                ident=ident,
+                threads=threads,
+                query_cov=mincov,
+                dbmatched_fn=otus_fn,
+                strand=strand)
+        finally:
+            os.remove(derep_fn)
+            os.remove(derep_uc_fn)
+    else:
+        micca.tp.vsearch.usearch_global(
+            input_fn=input_fn,
+            db_fn=ref_fn,
+            userout_fn=hits_fn,
+            ident=ident,
+            threads=threads,
+            userfields="query+target+id",
+            query_cov=mincov,
+            dbmatched_fn=otus_fn,
+            notmatched_fn=notmatched_fn,
+            strand=strand,
+            otutabout_fn=otutabout_fn)
 
     _rename_seqids(otus_fn, otuids_fn, prefix="REF")
     if otutable_fn is not None:
-        _hits_to_otutable(hits_fn, otuids_fn, otutable_fn)
+        _write_otutable(hits_fn, otuids_fn, otutable_fn, otutabout_fn)
 
 
+@_decompress_input
 def denovo_greedy(input_fn, output_dir, ident=0.97, threads=1, greedy="dgc",
-                  minsize=2, rmchim=False, chim_abskew=2.0):
+                  minsize=2, rmchim=False, chim_abskew=2.0,
+                  vsearch_otutable=False, derep_mapping=False):
 
     if not os.path.isdir(output_dir):
         raise ValueError("directory {} does not exist".format(output_dir))
 
+    if vsearch_otutable and derep_mapping:
+        raise ValueError("vsearch_otutable and derep_mapping are mutually "
+                         "exclusive")
+
     otus_fn = os.path.join(output_dir, _OTUS_FN)
     otuids_fn = os.path.join(output_dir, _OTUIDS_FN)
     hits_fn = os.path.join(output_dir, _HITS_FN)
     otuschim_fn = os.path.join(output_dir, _OTUSCHIM_FN)
     otutable_fn = os.path.join(output_dir, _OTUTABLE_FN)
 
-    _denovo_greedy(
-        input_fn=input_fn,
-        otus_fn=otus_fn,
-        otuids_fn=otuids_fn,
-        hits_fn=hits_fn,
-        otuschim_fn=otuschim_fn,
-        otutable_fn=otutable_fn,
-        ident=ident,
-        threads=threads,
-        greedy=greedy,
-        minsize=minsize,
-        rmchim=rmchim,
-        chim_abskew=chim_abskew)
+    otutabout_fn = None
+    if vsearch_otutable:
+        otutabout_fn = micca.ioutils.make_tempfile(output_dir)
+
+    try:
+        _denovo_greedy(
+            input_fn=input_fn,
+            otus_fn=otus_fn,
+            otuids_fn=otuids_fn,
+            hits_fn=hits_fn,
+            otuschim_fn=otuschim_fn,
+            otutable_fn=otutable_fn,
+            ident=ident,
+            threads=threads,
+            greedy=greedy,
+            minsize=minsize,
+            rmchim=rmchim,
+            chim_abskew=chim_abskew,
+            otutabout_fn=otutabout_fn,
+            derep_mapping=derep_mapping)
+    finally:
+        if otutabout_fn is not None:
+            os.remove(otutabout_fn)
+
+
+@_decompress_input
+def denovo_unoise(input_fn, output_dir, threads=1, minsize=8, unoise_alpha=2.0,
+                  rmchim=False, chim_abskew=16.0, vsearch_otutable=False,
+                  derep_mapping=False):
+
+    if not os.path.isdir(output_dir):
+        raise ValueError("directory {} does not exist".format(output_dir))
+
+    if vsearch_otutable and derep_mapping:
+        raise ValueError("vsearch_otutable and derep_mapping are mutually "
+                         "exclusive")
+
+    otus_fn = os.path.join(output_dir, _OTUS_FN)
+    otuids_fn = os.path.join(output_dir, _OTUIDS_FN)
+    hits_fn = os.path.join(output_dir, _HITS_FN)
+    otuschim_fn = os.path.join(output_dir, _OTUSCHIM_FN)
+    otutable_fn = os.path.join(output_dir, _OTUTABLE_FN)
+
+    otutabout_fn = None
+    if vsearch_otutable:
+        otutabout_fn = micca.ioutils.make_tempfile(output_dir)
+
+    try:
+        _denovo_unoise(
+            input_fn=input_fn,
+            otus_fn=otus_fn,
+            otuids_fn=otuids_fn,
+            hits_fn=hits_fn,
+            otuschim_fn=otuschim_fn,
+            otutable_fn=otutable_fn,
+            threads=threads,
+            minsize=minsize,
+            unoise_alpha=unoise_alpha,
+            rmchim=rmchim,
+            chim_abskew=chim_abskew,
+            otutabout_fn=otutabout_fn,
+            derep_mapping=derep_mapping)
+    finally:
+        if otutabout_fn is not None:
+            os.remove(otutabout_fn)
 
 
+@_decompress_input
 def closed_ref(input_fn, ref_fn, output_dir, ident=0.97, threads=1,
-               mincov=0.75, strand="both"):
+               mincov=0.75, strand="both", vsearch_otutable=False,
+               derep_mapping=False):
 
     if not os.path.isdir(output_dir):
         raise ValueError("directory {} does not exist".format(output_dir))
 
+    if vsearch_otutable and derep_mapping:
+        raise ValueError("vsearch_otutable and derep_mapping are mutually "
+                         "exclusive")
+
     otus_fn = os.path.join(output_dir, _OTUS_FN)
     otuids_fn = os.path.join(output_dir, _OTUIDS_FN)
     hits_fn = os.path.join(output_dir, _HITS_FN)
     otutable_fn = os.path.join(output_dir, _OTUTABLE_FN)
 
-    _closed_ref(
-        input_fn=input_fn,
-        ref_fn=ref_fn,
-        otus_fn=otus_fn,
-        otuids_fn=otuids_fn,
-        hits_fn=hits_fn,
-        otutable_fn=otutable_fn,
-        ident=ident,
-        threads=threads,
-        mincov=mincov,
-        strand=strand)
+    otutabout_fn = None
+    if vsearch_otutable:
+        otutabout_fn = micca.ioutils.make_tempfile(output_dir)
+
+    try:
+        _closed_ref(
+            input_fn=input_fn,
+            ref_fn=ref_fn,
+            otus_fn=otus_fn,
+            otuids_fn=otuids_fn,
+            hits_fn=hits_fn,
+            otutable_fn=otutable_fn,
+            ident=ident,
+            threads=threads,
+            mincov=mincov,
+            strand=strand,
+            otutabout_fn=otutabout_fn,
+            derep_mapping=derep_mapping)
+    finally:
+        if otutabout_fn is not None:
+            os.remove(otutabout_fn)
 
 
+@_decompress_input
 def open_ref(input_fn, ref_fn, output_dir, ident=0.97, threads=1, mincov=0.75,
              greedy="dgc", minsize=1, strand="both", rmchim=False,
-             chim_abskew=2):
+             chim_abskew=2, vsearch_otutable=False, derep_mapping=False):
 
     if not os.path.isdir(output_dir):
         raise ValueError("directory {} does not exist".format(output_dir))
 
+    if vsearch_otutable and derep_mapping:
+        raise ValueError("vsearch_otutable and derep_mapping are mutually "
+                         "exclusive")
+
     otus_fn = os.path.join(output_dir, _OTUS_FN)
     otuids_fn = os.path.join(output_dir, _OTUIDS_FN)
     hits_fn = os.path.join(output_dir, _HITS_FN)
     otuschim_fn = os.path.join(output_dir, _OTUSCHIM_FN)
     otutable_fn = os.path.join(output_dir, _OTUTABLE_FN)
 
+    # OTU tables written by VSEARCH (closed-reference and de novo steps)
+    otutables = []
+
     notmatched_fn = micca.ioutils.make_tempfile(output_dir)
+    otutabout_fn = None
+    if vsearch_otutable:
+        otutabout_fn = micca.ioutils.make_tempfile(output_dir)
     try:
         _closed_ref(
             input_fn=input_fn,
@@ -404,15 +870,25 @@ def open_ref(input_fn, ref_fn, output_dir, ident=0.97, threads=1, mincov=0.75,
             ident=ident,
             threads=threads,
             mincov=mincov,
-            strand=strand)
+            strand=strand,
+            otutabout_fn=otutabout_fn,
+            derep_mapping=derep_mapping)
+        if vsearch_otutable:
+            otutables.append(_otutabout_read(otutabout_fn, otuids_fn))
     except:
         os.remove(notmatched_fn)
         raise
+    finally:
+        if otutabout_fn is not None:
+            os.remove(otutabout_fn)
 
     if os.stat(notmatched_fn).st_size != 0:
         denovo_otus_fn = micca.ioutils.make_tempfile(output_dir)
         denovo_otuids_fn = micca.ioutils.make_tempfile(output_dir)
         denovo_hits_fn = micca.ioutils.make_tempfile(output_dir)
+        denovo_otutabout_fn = None
+        if vsearch_otutable:
+            denovo_otutabout_fn = micca.ioutils.make_tempfile(output_dir)
 
         try:
             _denovo_greedy(
@@ -427,12 +903,20 @@ def open_ref(input_fn, ref_fn, output_dir, ident=0.97, threads=1, mincov=0.75,
                 greedy=greedy,
                 minsize=minsize,
                 rmchim=rmchim,
-                chim_abskew=chim_abskew)
+                chim_abskew=chim_abskew,
+                otutabout_fn=denovo_otutabout_fn,
+                derep_mapping=derep_mapping)
+            if vsearch_otutable:
+                otutables.append(
+                    _otutabout_read(denovo_otutabout_fn, denovo_otuids_fn))
         except:
             os.remove(denovo_otus_fn)
             os.remove(denovo_otuids_fn)
             os.remove(denovo_hits_fn)
             raise
+        finally:
+            if denovo_otutabout_fn is not None:
+                os.remove(denovo_otutabout_fn)
 
         with open(otus_fn, 'a') as otus_handle:
             with open(denovo_otus_fn, 'rU') as denovo_otus_handle:
@@ -454,15 +938,17 @@ def open_ref(input_fn, ref_fn, output_dir, ident=0.97, threads=1, mincov=0.75,
 
     os.remove(notmatched_fn)
 
-    _hits_to_otutable(hits_fn, otuids_fn, otutable_fn)
+    # tables with ambiguous OTU ids are None (see _otutabout_read())
+    if vsearch_otutable and all(t is not None for t in otutables):
+        _otutabout_to_otutable(otutables, otuids_fn, otutable_fn)
+    else:
+        _hits_to_otutable(hits_fn, otuids_fn, otutable_fn)
 
 
+@_decompress_input
 def denovo_swarm(input_fn, output_dir, differences=1, fastidious=True,
                  threads=1, rmchim=False, minsize=1):
 
-    def strip_size(s):
-        return re.sub(r'(^|;)size=([0-9]+)(;|$)', '', s)
-
     if not os.path.isdir(output_dir):
         raise ValueError("directory {} does not exist".format(output_dir))
 
@@ -488,25 +974,20 @@ def denovo_swarm(input_fn, output_dir, differences=1, fastidious=True,
         os.remove(derep_uc_fn)
         return
 
-    # store the uc file in a sqlite3 database
-    derep_hitssqlite_fn = micca.ioutils.make_tempfile(output_dir)
-    _uc_to_hitssqlite(derep_uc_fn, derep_hitssqlite_fn)
-    os.remove(derep_uc_fn)
-
     # sort by size and filter by minimum size
     derep_sort_fn = micca.ioutils.make_tempfile(output_dir)
     try:
         micca.tp.vsearch.sortbysize(derep_fn, derep_sort_fn, minsize=minsize)
     except:
         os.remove(derep_sort_fn)
-        os.remove(derep_hitssqlite_fn)
+        os.remove(derep_uc_fn)
         raise
     finally:
         os.remove(derep_fn)
 
     if os.stat(derep_sort_fn).st_size == 0:
         os.remove(derep_sort_fn)
-        os.remove(derep_hitssqlite_fn)
+        os.remove(derep_uc_fn)
         return
 
     # swarm clustering
@@ -524,7 +1005,7 @@ def denovo_swarm(input_fn, output_dir, differences=1, fastidious=True,
     except:
         os.remove(swarms_temp_fn)
         os.remove(otus_temp_fn)
-        os.remove(derep_hitssqlite_fn)
+        os.remove(derep_uc_fn)
         raise
     finally:
         os.remove(derep_sort_fn)
@@ -540,56 +1021,57 @@ def denovo_swarm(input_fn, output_dir, differences=1, fastidious=True,
                 nonchimeras_fn=otus_nochim_fn)
         except:
             os.remove(otus_nochim_fn)
-            os.remove(derep_hitssqlite_fn)
+            os.remove(derep_uc_fn)
             raise
         finally:
             os.remove(otus_temp_fn)
 
         if os.stat(otus_nochim_fn).st_size == 0:
             os.remove(otus_nochim_fn)
-            os.remove(derep_hitssqlite_fn)
+            os.remove(swarms_temp_fn)
+            os.remove(derep_uc_fn)
             return
     else:
         otus_nochim_fn = otus_temp_fn
 
     # write the OTUs file and store the OTU ids
-    otuids = []
+    otuids = set()
     otus_nochim_handle = open(otus_nochim_fn, "rU")
     otus_handle = open(otus_fn, "wb")
     for i, (title, seq) in enumerate(SimpleFastaParser(otus_nochim_handle)):
-        otuid = strip_size(title.split()[0])
-        otuids.append(otuid)
+        otuid = _strip_size(title.split()[0])
+        otuids.add(otuid)
         otus_handle.write(">{}\n{}\n".format(otuid, seq.upper()))
 
     otus_nochim_handle.close()
     otus_handle.close()
     os.remove(otus_nochim_fn)
 
-    # write the hits file
-    swarms_temp_handle = open(swarms_temp_fn, 'rU')
-    swarms_temp_reader = csv.reader(swarms_temp_handle, delimiter=' ')
+    # write the hits file. The reads of each dereplicated sequence are
+    # retrieved from an in-memory index of the .uc file or, if the
+    # index does not fit in memory, from a SQLite database
+    memory = _available_memory()
+    index_memory = os.stat(derep_uc_fn).st_size * _UC_INDEX_MEMORY_RATIO
     hits_handle = open(hits_fn, 'wb')
     hits_writer = csv.writer(hits_handle, delimiter='\t', lineterminator='\n')
-    con = sqlite3.connect(derep_hitssqlite_fn)
-    cur = con.cursor()
-
-    for otu in swarms_temp_reader:
-        otuid = strip_size(otu[0])
-        if otuid in otuids:
-            for derep in otu:
-                derep = strip_size(derep)
-                cur.execute('SELECT query FROM hits WHERE target=?', (derep, ))
-                amplicons = [elem[0] for elem in cur.fetchall()]
-                for amplicon in amplicons:
-                    hits_writer.writerow([amplicon, otuid, '*'])
-
-    cur.close()
-    con.close()
-    hits_handle.close()
-    swarms_temp_handle.close()
-
-    os.remove(swarms_temp_fn)
-    os.remove(derep_hitssqlite_fn)
+    try:
+        if (memory is None) or (index_memory < memory):
+            hits = _swarm_hits_index(swarms_temp_fn, otuids, derep_uc_fn)
+            hits_writer.writerows((query, otuid, '*')
+                                  for query, otuid in hits)
+        else:
+            derep_hitssqlite_fn = micca.ioutils.make_tempfile(output_dir)
+            try:
+                hits = _swarm_hits_sqlite(swarms_temp_fn, otuids,
+                                          derep_uc_fn, derep_hitssqlite_fn)
+                hits_writer.writerows((query, otuid, '*')
+                                      for query, otuid in hits)
+            finally:
+                os.remove(derep_hitssqlite_fn)
+    finally:
+        hits_handle.close()
+        os.remove(swarms_temp_fn)
+        os.remove(derep_uc_fn)
 
     _rename_seqids(otus_fn, otuids_fn, prefix="DENOVO")
     _hits_to_otutable(hits_fn, otuids_fn, otutable_fn)
@@ -60,6 +60,8 @@ def main(argv):
         allowed number of Ns.
 
         micca-filter is based on VSEARCH (https://github.com/torognes/vsearch).
+        With --engine native, reads are filtered in-process with the same
+        semantics of VSEARCH, optionally in parallel (-p/--threads).
     ''')
 
     epilog = textwrap.dedent('''\
@@ -69,6 +71,11 @@ def main(argv):
         (with EE rate > 0.5%%) and write a FASTA file:
 
             micca filter -i reads.fastq -o filtered.fasta -m 300 -t -e 0.5
+
+        As above, using the native engine and 4 processes:
+
+            micca filter -i reads.fastq -o filtered.fasta -m 300 -t -e 0.5 \\
+            --engine native -p 4
     ''')
 
     parser = argparse.ArgumentParser(
@@ -103,8 +110,19 @@ def main(argv):
     group.add_argument('-f', '--output-format', default="fasta",
                        choices=["fastq", "fasta"],
                        help="file format (default %(default)s).")
+    group.add_argument('--engine', default="vsearch",
+                       choices=["vsearch", "native"],
+                       help="filtering engine, VSEARCH or in-process (native). "
+                       "The native engine does not support multi-line FASTQ "
+                       "files (default %(default)s).")
+    group.add_argument('-p', '--threads', default=1, type=int,
+                       help="number of processes to use with --engine native "
+                       "(default %(default)s).")
     args = parser.parse_args(argv)
 
+    if (args.threads > 1) and (args.engine != "native"):
+        parser.error("-p/--threads requires --engine native")
+
 
     try:
         micca.api.filter(
@@ -114,7 +132,9 @@ def main(argv):
             maxns=args.maxns,
             minlen=args.minlen,
             trunc=args.trunc,
-            output_fmt=args.output_format)
+            output_fmt=args.output_format,
+            engine=args.engine,
+            threads=args.threads)
     except Exception as err:
         sys.stderr.write("Error: {}\n".format(err))
         sys.exit(1)
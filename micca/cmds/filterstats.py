@@ -87,6 +87,19 @@ def main(argv):
                        "%(default)s)")
     group.add_argument('-n', '--maxns', type=int,
                        help="max number of Ns. (disabled by default).")
+    group.add_argument('-p', '--threads', default=1, type=int,
+                       help="number of processes to use; the input file is "
+                       "split in chunks processed in parallel. Ignored when "
+                       "-t/--topn is specified (default %(default)s).")
+    group.add_argument('-s', '--sample', type=int,
+                       help="perform statistics only on about SAMPLE reads "
+                       "taken at random positions of the input file, without "
+                       "reading it entirely. The statistical error of the "
+                       "reported percentages is printed (disabled by "
+                       "default).")
+    group.add_argument('--seed', default=0, type=int,
+                       help="random seed for -s/--sample (default "
+                       "%(default)s).")
     args = parser.parse_args(argv)
 
 
@@ -96,7 +109,10 @@ def main(argv):
             output_dir=args.output,
             topn=args.topn,
             maxeerates=args.maxeerates,
-            maxns=args.maxns)
+            maxns=args.maxns,
+            threads=args.threads,
+            sample=args.sample,
+            seed=args.seed)
     except Exception as err:
         sys.stderr.write("Error: {}\n".format(err))
         sys.exit(1)
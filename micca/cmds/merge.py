@@ -67,6 +67,9 @@ def main(argv):
     group.add_argument('-f', '--format', default="fastq",
                        choices=["fastq", "fasta"],
                        help="file format (default %(default)s).")
+    group.add_argument('-p', '--threads', default=1, type=int,
+                       help="number of processes to use; input files are "
+                       "processed in parallel (default %(default)s).")
     args = parser.parse_args(argv)
 
 
@@ -75,7 +78,8 @@ def main(argv):
             input_fns=args.input,
             output_fn=args.output,
             sep=args.sep,
-            fmt=args.format)
+            fmt=args.format,
+            threads=args.threads)
     except Exception as err:
         sys.stderr.write("Error: {}\n".format(err))
         sys.exit(1)
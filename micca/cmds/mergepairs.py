@@ -131,7 +131,12 @@ def main(argv):
                        help="write not merged reverse reads.")
     group.add_argument('-t', '--threads', default=1, type=int,
                        help="number of threads to use (1 to 256, default "
-                       "%(default)s).")   
+                       "%(default)s).")
+    group.add_argument('-j', '--jobs', default=1, type=int,
+                       help="when the reverse file name is not specified, "
+                       "number of samples merged at the same time. Each "
+                       "sample uses -t/--threads threads (default "
+                       "%(default)s).")
 
     args = parser.parse_args(argv)
 
@@ -151,7 +156,8 @@ def main(argv):
             repl=args.repl,
             sep=args.sep,
             nostagger=args.nostagger,
-            threads=args.threads)
+            threads=args.threads,
+            jobs=args.jobs)
     except Exception as err:
         sys.stderr.write("Error: {}\n".format(err))
         sys.exit(1)
\ No newline at end of file
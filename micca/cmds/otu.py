@@ -147,6 +147,21 @@ def main(argv):
                        help="search both strands or the plus strand only "
                        "(for 'closed_ref' and 'open_ref' clustering methods, "
                        "default %(default)s).")
+    group.add_argument('--vsearch-otutable', default=False,
+                       action="store_true",
+                       help="build the OTU table directly in VSEARCH while "
+                       "mapping the reads, instead of counting the hits in "
+                       "hits.txt (not available for 'denovo_swarm'). Reads "
+                       "without the 'sample=' annotation are assigned to the "
+                       "sample named as the first word of their label "
+                       "(instead of 'noname').")
+    group.add_argument('--derep-mapping', default=False,
+                       action="store_true",
+                       help="map only the unique sequences (found in the "
+                       "dereplication step) to the OTUs and assign the hits "
+                       "to the reads afterwards, instead of mapping all the "
+                       "reads (not available for 'denovo_swarm', not "
+                       "compatible with --vsearch-otutable).")
 
     # chimeras
     group_chim = parser.add_argument_group("Chimera removal specific options")
@@ -189,6 +204,18 @@ def main(argv):
         parser.error("%s OTU picking method requires reference sequences "
                      "(--ref)" % args.method)
 
+    if args.vsearch_otutable and (args.method == "denovo_swarm"):
+        parser.error("--vsearch-otutable is not available for the "
+                     "denovo_swarm OTU picking method")
+
+    if args.derep_mapping and (args.method == "denovo_swarm"):
+        parser.error("--derep-mapping is not available for the "
+                     "denovo_swarm OTU picking method")
+
+    if args.vsearch_otutable and args.derep_mapping:
+        parser.error("--vsearch-otutable and --derep-mapping are mutually "
+                     "exclusive")
+
     if args.minsize is None:
         if args.method in ["denovo_greedy", "open_ref"]:
             minsize = 2
@@ -217,7 +244,9 @@ def main(argv):
                 greedy=args.greedy,
                 minsize=minsize,
                 rmchim=args.rmchim,
-                chim_abskew=chim_abskew)
+                chim_abskew=chim_abskew,
+                vsearch_otutable=args.vsearch_otutable,
+                derep_mapping=args.derep_mapping)
 
         elif args.method == "denovo_unoise":
             micca.api.otu.denovo_unoise(
@@ -227,7 +256,9 @@ def main(argv):
                 minsize=minsize,
                 unoise_alpha=args.unoise_alpha,
                 rmchim=args.rmchim,
-                chim_abskew=chim_abskew)
+                chim_abskew=chim_abskew,
+                vsearch_otutable=args.vsearch_otutable,
+                derep_mapping=args.derep_mapping)
 
         elif args.method == "denovo_swarm":
             micca.api.otu.denovo_swarm(
@@ -247,7 +278,9 @@ def main(argv):
                 ident=args.id,
                 threads=args.threads,
                 mincov=args.mincov,
-                strand=args.strand)
+                strand=args.strand,
+                vsearch_otutable=args.vsearch_otutable,
+                derep_mapping=args.derep_mapping)
 
         else:
             micca.api.otu.open_ref(
@@ -261,7 +294,9 @@ def main(argv):
                 minsize=minsize,
                 strand=args.strand,
                 rmchim=args.rmchim,
-                chim_abskew=chim_abskew)
+                chim_abskew=chim_abskew,
+                vsearch_otutable=args.vsearch_otutable,
+                derep_mapping=args.derep_mapping)
     except Exception as err:
         sys.stderr.write("Error: {}\n".format(err))
         sys.exit(1)
@@ -0,0 +1,139 @@
+##    Copyright 2015 Davide Albanese <davide.albanese@gmail.com>
+##    Copyright 2015 Fondazione Edmund Mach (FEM)
+
+##    This file is part of micca.
+##
+##    micca is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    micca is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with micca.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+import sys
+import argparse
+import textwrap
+
+import micca.api
+
+
+def main(argv):
+    prog = "micca preprocess"
+
+    description = textwrap.dedent('''\
+        micca preprocess trims the primers (see 'micca trim'), filters
+        (see 'micca filter') and merges (see 'micca merge') one or more
+        FASTQ files (one for each sample) into a single FASTA file in a
+        single pass, without intermediate files. Reads are streamed from
+        Cutadapt to the filter, with the same semantics of the filter
+        command, and the sample names are appended to the sequence
+        identifiers (e.g. >SEQID;sample=SAMPLENAME). The output is the same
+        as running trim, filter and merge in sequence.
+
+        Sample names are defined as the leftmost part of the file name
+        splitted by the first occurence of 'SEP' (-s/--sep). Primer trimming
+        is skipped if neither -w/--forward nor -r/--reverse is specified.
+    ''')
+
+    epilog = textwrap.dedent('''\
+        Examples
+
+        Illumina overlapping paired-end (already merged) reads: trim forward
+        and reverse primers (discarding reads that do not contain them),
+        discard reads shorter than 250 bp or with EE rate > 0.75% and merge
+        the samples:
+
+            micca preprocess -i A.fastq B.fastq -o preprocessed.fasta \\
+            -w AGGATTAGATACCCTGGTA -r CRRCACGAGCTGACGAC -W -R -m 250 -e 0.75
+    ''')
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        prog=prog,
+        description=description,
+        epilog=epilog)
+
+    group = parser.add_argument_group("arguments")
+
+    group.add_argument('-i', '--input', nargs='+', metavar="FILE",
+                       required=True,
+                       help="input FASTQ file(s), Sanger/Illumina 1.8+ "
+                       "format (phred+33) (required).")
+    group.add_argument('-o', '--output', metavar="FILE", required=True,
+                       help="output FASTA file (required).")
+    group.add_argument('-s', '--sep', default=".",
+                       help="Sample names are defined as the leftmost part of "
+                       "the file name splitted by the first occurence of "
+                       "'SEP' (default %(default)s)")
+
+    group_trim = parser.add_argument_group("Trimming options")
+    group_trim.add_argument('-w', '--forward', help="trim forward primer(s). "
+                            "Only the best matching primer is removed.",
+                            nargs='+')
+    group_trim.add_argument('-r', '--reverse', help="trim reverse primer(s). "
+                            "Only the best matching primer is removed.",
+                            nargs='+')
+    group_trim.add_argument('--maxerate', type=float, default=0.1,
+                            help="maximum allowed error rate (default "
+                            "%(default)s).")
+    group_trim.add_argument('-c', '--searchrc', action="store_true",
+                            default=False,
+                            help="search reverse complement primers too "
+                            "(default %(default)s).")
+    group_trim.add_argument('-W', '--duforward', action="store_true",
+                            default=False,
+                            help="discard reads that do not contain the "
+                            "forward primer (default %(default)s).")
+    group_trim.add_argument('-R', '--dureverse', action="store_true",
+                            default=False,
+                            help="discard reads that do not contain the "
+                            "reverse primer (default %(default)s).")
+    group_trim.add_argument('-p', '--threads', default=1, type=int,
+                            help="number of CPU cores used by cutadapt in "
+                            "each trimming pass (requires cutadapt >= 2.0 "
+                            "running on Python 3) (default %(default)s).")
+
+    group_filter = parser.add_argument_group("Filtering options")
+    group_filter.add_argument('-e', '--maxeerate', type=float, default=1,
+                              help="discard sequences with more than the "
+                              "specified expected error rate %% (default "
+                              "%(default)s).")
+    group_filter.add_argument('-m', '--minlen', type=int, default=1,
+                              help="discard sequences that are shorter than "
+                              "MINLEN (default %(default)s).")
+    group_filter.add_argument('-t', '--trunc', default=False,
+                              action="store_true",
+                              help="truncate sequences that are longer than "
+                              "MINLEN (disabled by default).")
+    group_filter.add_argument('-n', '--maxns', type=int,
+                              help="discard sequences with more than the "
+                              "specified number of Ns (disabled by default).")
+    args = parser.parse_args(argv)
+
+    try:
+        micca.api.preprocess(
+            input_fns=args.input,
+            output_fn=args.output,
+            forward=args.forward,
+            reverse=args.reverse,
+            maxerate=args.maxerate,
+            searchrc=args.searchrc,
+            duforward=args.duforward,
+            dureverse=args.dureverse,
+            maxee_rate=args.maxeerate,
+            maxns=args.maxns,
+            minlen=args.minlen,
+            trunc=args.trunc,
+            sep=args.sep,
+            threads=args.threads)
+    except Exception as err:
+        sys.stderr.write("Error: {}\n".format(err))
+        sys.exit(1)
@@ -23,6 +23,7 @@ import argparse
 import textwrap
 
 import micca.api
+from micca import argutils
 
 
 def main(argv):
@@ -47,6 +48,10 @@ def main(argv):
         >SEQ1;sample=SAMPLE1
         GCCACGGCTAACTAC...
         ...
+
+        Reads are assigned to the barcode with the minimum number of errors
+        (mismatches). Reads matching two or more barcodes with the same minimum
+        number of errors are considered as not matched (ambiguous).
     ''')
 
     epilog = textwrap.dedent('''\
@@ -57,6 +62,11 @@ def main(argv):
 
             micca split -i input.fastq -o splitted.fastq -b barcode.fasta \\
             -n notmatched.fastq
+
+        Write the reads of each sample in the directory 'samples' (files
+        samples/SAMPLENAME.fastq.gz):
+
+            micca split -i input.fastq -d samples -b barcode.fasta
     ''')
 
     parser = argparse.ArgumentParser(
@@ -69,8 +79,9 @@ def main(argv):
 
     group.add_argument('-i', '--input', metavar="FILE", required=True,
                        help="input FASTQ/FASTA file (required).")
-    group.add_argument('-o', '--output', metavar="FILE", required=True,
-                       help="output FASTQ/FASTA file (required).")
+    group.add_argument('-o', '--output', metavar="FILE",
+                       help="output FASTQ/FASTA file (required unless "
+                       "-d/--sampledir is specified).")
     group.add_argument('-b', '--barcode', metavar="FILE", required=True,
                        help="barcode file in FASTA format (required).")
     group.add_argument('-n', '--notmatched', metavar="FILE",
@@ -91,8 +102,26 @@ def main(argv):
     group.add_argument('-f', '--format', default="fastq",
                        choices=["fastq", "fasta"],
                        help="file format (default %(default)s).")
+    group.add_argument('-p', '--threads', default=1, type=int,
+                       help="number of processes to use; the input file is "
+                       "split in chunks processed in parallel (default "
+                       "%(default)s).")
+    group.add_argument('-d', '--sampledir', metavar="DIR",
+                       type=argutils.outputdir,
+                       help="write the reads of each sample in a separate "
+                       "gzip-compressed file DIR/SAMPLENAME.fastq.gz (or "
+                       ".fasta.gz), without the sample information in the "
+                       "sequence identifiers. Files are created only for "
+                       "samples with at least one read.")
+    group.add_argument('--maxfiles', type=int, default=64,
+                       help="maximum number of per-sample files kept open at "
+                       "the same time (default %(default)s).")
     args = parser.parse_args(argv)
 
+    if (args.output is None) and (args.sampledir is None):
+        parser.error("at least one option between -o/--output and "
+                     "-d/--sampledir is required")
+
 
     try:
         micca.api.split(
@@ -104,7 +133,10 @@ def main(argv):
             skip=args.skip,
             maxe=args.maxe,
             trim=(not args.notrim),
-            fmt=args.format)
+            fmt=args.format,
+            threads=args.threads,
+            sample_dir=args.sampledir,
+            maxfiles=args.maxfiles)
     except Exception as err:
         sys.stderr.write("Error: {}\n".format(err))
         sys.exit(1)
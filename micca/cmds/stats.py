@@ -43,7 +43,14 @@ def main(argv):
 
         Moreover, micca stats returns the respective plots in PNG format,
         stats_lendist_plot.png, stats_qualdist_plot.png, and
-        stats_qualsumm_plot.png.
+        stats_qualsumm_plot.png, and the file stats_acc.npz containing the
+        raw counts. The stats_acc.npz files of several runs (e.g. one for
+        each sequencing lane) can be combined with the -c/--combine option,
+        without reading the sequences again.
+
+        With the option --with-filterstats, the outputs of 'micca
+        filterstats' are computed in the same pass over the input file and
+        written in the output directory.
     ''')
 
     epilog = textwrap.dedent('''\
@@ -52,6 +59,19 @@ def main(argv):
         Compute statistics on the top 10000 sequences of input.fastq:
 
             micca stats -i input.fastq -o stats -n 10000
+
+        Combine the statistics computed on two sequencing lanes:
+
+            micca stats -c lane1/stats_acc.npz lane2/stats_acc.npz -o stats
+
+        Compute statistics and filter statistics reading input.fastq once:
+
+            micca stats -i input.fastq -o stats --with-filterstats
+
+        Compute statistics on about 100000 reads sampled at random from
+        input.fastq:
+
+            micca stats -i input.fastq -o stats -s 100000
     ''')
 
     parser = argparse.ArgumentParser(
@@ -62,23 +82,66 @@ def main(argv):
 
     group = parser.add_argument_group("arguments")
 
-    group.add_argument('-i', '--input', metavar="FILE", required=True,
+    group.add_argument('-i', '--input', metavar="FILE",
                        help="input FASTQ file, Sanger/Illumina 1.8+ format "
-                       "(phred+33) (required).")
+                       "(phred+33) (required unless -c/--combine is "
+                       "specified).")
     group.add_argument('-o', '--output', metavar='DIR', default=".",
                        help="output directory (default %(default)s).",
                        type=argutils.outputdir)
     group.add_argument('-n', '--topn', type=int,
                        help="perform statistics only on the first TOPN "
                        "sequences (disabled by default).")
+    group.add_argument('-p', '--threads', default=1, type=int,
+                       help="number of processes to use; the input file is "
+                       "split in chunks processed in parallel. Ignored when "
+                       "-n/--topn is specified (default %(default)s).")
+    group.add_argument('-s', '--sample', type=int,
+                       help="perform statistics only on about SAMPLE reads "
+                       "taken at random positions of the input file, without "
+                       "reading it entirely. The statistical error of the "
+                       "reported percentages is printed (disabled by "
+                       "default).")
+    group.add_argument('--seed', default=0, type=int,
+                       help="random seed for -s/--sample (default "
+                       "%(default)s).")
+    group.add_argument('-c', '--combine', nargs='+', metavar="FILE",
+                       help="combine the stats_acc.npz files produced by "
+                       "previous runs instead of reading an input file.")
+
+    group_fs = parser.add_argument_group("Filter statistics options")
+    group_fs.add_argument('--with-filterstats', default=False,
+                          action="store_true",
+                          help="compute also the filter statistics (see "
+                          "'micca filterstats') in the same pass.")
+    group_fs.add_argument('--maxeerates', nargs='+', type=float,
+                          default=[0.25, 0.5, 0.75, 1, 1.25, 1.5],
+                          help="max expected error rates (%%). (default "
+                          "%(default)s)")
+    group_fs.add_argument('--maxns', type=int,
+                          help="max number of Ns. (disabled by default).")
     args = parser.parse_args(argv)
 
+    if (args.input is None) == (args.combine is None):
+        parser.error("exactly one option between -i/--input and -c/--combine "
+                     "is required")
 
     try:
-        micca.api.stats(
-            input_fn=args.input,
-            output_dir=args.output,
-            topn=args.topn)
+        if args.combine is None:
+            micca.api.stats(
+                input_fn=args.input,
+                output_dir=args.output,
+                topn=args.topn,
+                threads=args.threads,
+                filterstats=args.with_filterstats,
+                maxeerates=args.maxeerates,
+                maxns=args.maxns,
+                sample=args.sample,
+                seed=args.seed)
+        else:
+            micca.api.stats_combine(
+                input_fns=args.combine,
+                output_dir=args.output)
     except Exception as err:
         sys.stderr.write("Error: {}\n".format(err))
         sys.exit(1)
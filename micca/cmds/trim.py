@@ -96,6 +96,10 @@ def main(argv):
     group.add_argument('-f', '--format', default="fastq",
                        choices=["fastq", "fasta"],
                        help="file format (default %(default)s).")
+    group.add_argument('-t', '--threads', default=1, type=int,
+                       help="number of CPU cores used by cutadapt in each "
+                       "trimming pass (requires cutadapt >= 2.0 running on "
+                       "Python 3) (default %(default)s).")
     args = parser.parse_args(argv)
 
     if (args.forward is None) and (args.reverse is None):
@@ -112,7 +116,8 @@ def main(argv):
             searchrc=args.searchrc,
             duforward=args.duforward,
             dureverse=args.dureverse,
-            fmt=args.format)
+            fmt=args.format,
+            threads=args.threads)
     except Exception as err:
         sys.stderr.write("Error: {}\n".format(err))
         sys.exit(1)
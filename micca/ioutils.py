@@ -1,7 +1,489 @@
+import os
+import os.path
+import errno
+import collections
 import tempfile
+import subprocess
+import signal
+import shutil
+import threading
+import gzip
+import bz2
+import zlib
+from distutils.spawn import find_executable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# magic numbers of the supported compressed file formats
+_MAGIC = [
+    ("gzip", "\x1f\x8b"),
+    ("bzip2", "BZh"),
+    ("zstd", "\x28\xb5\x2f\xfd")]
+
+# compressed file formats of the output files, by file name extension
+_EXTENSIONS = {
+    ".gz": "gzip",
+    ".bz2": "bzip2",
+    ".zst": "zstd"}
+
+# external decompression commands (reading the file given as last argument)
+# in order of preference, multi-threaded first
+_DECOMPRESS_CMDS = {
+    "gzip": [["pigz", "-dc"], ["igzip", "-dc"], ["gzip", "-dc"]],
+    "bzip2": [["pbzip2", "-dc"], ["lbzip2", "-dc"], ["bzip2", "-dc"]],
+    "zstd": [["zstd", "-dcq", "-T0"]]}
+
+# external compression commands (from stdin to stdout) in order of
+# preference, multi-threaded first
+_COMPRESS_CMDS = {
+    "gzip": [["pigz", "-c"], ["gzip", "-c"]],
+    "bzip2": [["pbzip2", "-c"], ["lbzip2", "-c"], ["bzip2", "-c"]],
+    "zstd": [["zstd", "-cq", "-T0"]]}
+
+# buffer size in bytes of the pipes and of the fifo feeders
+_BUFFER_SIZE = 1024*1024
 
 
 def make_tempfile(dir):
     h = tempfile.NamedTemporaryFile(delete=False, prefix="tmp", dir=dir)
     h.close()
     return h.name
+
+
+def compression(fn):
+    """Returns the compression format of the file ('gzip', 'bzip2' or
+    'zstd'), detected by its magic number, or None if the file is not
+    compressed (or it is not a regular file).
+    """
+
+    if not os.path.isfile(fn):
+        return None
+    with open(fn, 'rb') as handle:
+        head = handle.read(4)
+    for fmt, magic in _MAGIC:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+def _find_cmd(cmds):
+    """Returns the first available command in cmds, None otherwise.
+    """
+
+    for cmd in cmds:
+        cmd_bin = find_executable(cmd[0])
+        if cmd_bin is not None:
+            return [cmd_bin] + cmd[1:]
+    return None
+
+
+def _default_sigpipe():
+    """Restores the default SIGPIPE handler (ignored by Python) in the
+    child processes, so that a process writing to a closed pipe terminates.
+    """
+
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+class _ProcessFile(object):
+    """File object reading the standard output (or writing the standard
+    input) of a (de)compression process. close() waits for the process and
+    raises IOError if it fails. A reader closed before the end of the
+    stream terminates the process.
+    """
+
+    def __init__(self, proc, handle, stderr, name):
+        self.__proc = proc
+        self.__handle = handle
+        self.__stderr = stderr
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.__handle, attr)
+
+    def __iter__(self):
+        return iter(self.__handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.__handle.closed:
+            return
+        self.__handle.close()
+        self.__proc.wait()
+        try:
+            # terminated by SIGPIPE: the reader was closed early
+            if self.__proc.returncode not in [0, -signal.SIGPIPE]:
+                self.__stderr.seek(0)
+                raise IOError("{}: {}".format(
+                    self.name, self.__stderr.read().strip()))
+        finally:
+            self.__stderr.close()
+
+
+class _CompressedFile(object):
+    """Write-only file object compressing the data with the compressor
+    object (with the compress() and flush() methods) before writing it to
+    the handle.
+    """
+
+    def __init__(self, handle, compressor):
+        self.__handle = handle
+        self.__compressor = compressor
+        self.name = handle.name
+
+    def write(self, data):
+        self.__handle.write(self.__compressor.compress(data))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.__handle.closed:
+            return
+        try:
+            self.__handle.write(self.__compressor.flush())
+        finally:
+            self.__handle.close()
+
+
+class _LineReader(object):
+    """Read-only file object reading the data from handles[0] through its
+    read(size) method only (the zstandard stream reader, for instance, does
+    not provide readline() and it is not iterable) and closing all the
+    handles in order on close(). If universal is True, '\\r\\n' and '\\r'
+    line endings are translated to '\\n', as in the 'rU' mode of open().
+    """
+
+    def __init__(self, handles, universal, name):
+        self.__handles = handles
+        self.__universal = universal
+        self.__buffer = ""
+        self.__pos = 0
+        self.closed = False
+        self.name = name
+
+    def __read(self):
+        """Returns the next chunk of data ("" at the end of the file)."""
+
+        data = self.__handles[0].read(_BUFFER_SIZE)
+        if self.__universal:
+            # a '\r' at the end of the chunk may be followed by '\n'
+            while data.endswith('\r'):
+                more = self.__handles[0].read(1)
+                if not more:
+                    break
+                data += more
+            data = data.replace('\r\n', '\n').replace('\r', '\n')
+        return data
+
+    def read(self, size=-1):
+        chunks = [self.__buffer[self.__pos:]]
+        length = len(chunks[0])
+        while (size < 0) or (length < size):
+            data = self.__read()
+            if not data:
+                break
+            chunks.append(data)
+            length += len(data)
+
+        data = "".join(chunks)
+        if size < 0:
+            size = length
+        self.__buffer, self.__pos = data, size
+        return data[:size]
+
+    def readline(self):
+        while True:
+            end = self.__buffer.find('\n', self.__pos)
+            if end >= 0:
+                line = self.__buffer[self.__pos:end+1]
+                self.__pos = end+1
+                return line
+
+            data = self.__read()
+            self.__buffer, self.__pos = self.__buffer[self.__pos:]+data, 0
+            if not data:
+                line, self.__buffer = self.__buffer, ""
+                return line
+
+    def readlines(self, sizehint=-1):
+        data = self.read(sizehint if sizehint > 0 else -1)
+        if not data.endswith('\n'):
+            data += self.readline()
+        lines = [line + '\n' for line in data.split('\n')]
+        lines[-1] = lines[-1][:-1]
+        if not lines[-1]:
+            lines.pop()
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for handle in self.__handles:
+            handle.close()
+
+
+class _BZ2Reader(object):
+    """Decompresses all the streams of the bzip2 file (Python 2 BZ2File
+    reads only the first one, while pbzip2 and open_output(fn, 'ab') write
+    multi-stream files). read(size) returns the data decompressed from
+    'size' bytes of the file at a time ("" at the end of the file), as
+    required by _LineReader.
+    """
+
+    def __init__(self, handle):
+        self.__handle = handle
+        self.__decompressor = None
+        self.__unused = ""
+
+    def read(self, size):
+        while True:
+            data, self.__unused = self.__unused, ""
+            if not data:
+                data = self.__handle.read(size)
+            if not data:
+                break
+
+            if self.__decompressor is None:
+                self.__decompressor = bz2.BZ2Decompressor()
+            try:
+                output = self.__decompressor.decompress(data)
+            except EOFError:
+                # the previous stream ended exactly at the end of the chunk
+                self.__decompressor = None
+                self.__unused = data
+                continue
+
+            # start of a new stream
+            if self.__decompressor.unused_data:
+                self.__unused = self.__decompressor.unused_data
+                self.__decompressor = None
+            if output:
+                return output
+
+        # the end of the last stream must have been reached
+        if self.__decompressor is not None:
+            try:
+                self.__decompressor.decompress("")
+            except EOFError:
+                pass
+            else:
+                raise IOError("{}: compressed file ended before the "
+                              "end-of-stream marker was reached".format(
+                                  self.__handle.name))
+        return ""
+
+    def close(self):
+        self.__handle.close()
+
+
+def _open_input_python(fn, fmt, mode):
+    """Opens the compressed file for reading using the Python modules. As
+    for the external processes, universal newlines are enabled if 'U' is in
+    mode.
+    """
+
+    if fmt == "gzip":
+        handles = [gzip.open(fn, 'rb')]
+    elif fmt == "bzip2":
+        handles = [_BZ2Reader(open(fn, 'rb'))]
+    elif (fmt == "zstd") and (zstandard is not None):
+        # the stream reader does not close the underlying file
+        handle = open(fn, 'rb')
+        handles = [zstandard.ZstdDecompressor().stream_reader(handle), handle]
+    else:
+        raise ValueError("{}: no {} decompressor available (install the "
+                         "command line tool or the Python module)".format(
+                             fn, fmt))
+    return _LineReader(handles, 'U' in mode, fn)
+
+
+def _compressor_python(fmt):
+    """Returns a compressor object for the format using the Python modules.
+    """
+
+    if fmt == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    elif fmt == "bzip2":
+        return bz2.BZ2Compressor()
+    elif (fmt == "zstd") and (zstandard is not None):
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError("no {} compressor available".format(fmt))
+
+
+def open_input(fn, mode='rU'):
+    """Opens the file for reading. gzip, bzip2 and zstd compressed files
+    (detected by their magic number) are decompressed on the fly by an
+    external process (pigz, pbzip2, zstd, ... when available) or by the
+    Python modules. In both cases, universal newlines are enabled if 'U' is
+    in mode.
+    """
+
+    fmt = compression(fn)
+    if fmt is None:
+        return open(fn, mode)
+
+    cmd = _find_cmd(_DECOMPRESS_CMDS[fmt])
+    if cmd is None:
+        return _open_input_python(fn, fmt, mode)
+
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd + [fn], stdout=subprocess.PIPE,
+                            stderr=stderr, bufsize=_BUFFER_SIZE,
+                            universal_newlines='U' in mode,
+                            preexec_fn=_default_sigpipe, close_fds=True)
+    return _ProcessFile(proc, proc.stdout, stderr, fn)
+
+
+def open_output(fn, mode='wb'):
+    """Opens the file for writing ('wb') or appending ('ab'). Files with
+    extension .gz, .bz2 or .zst are compressed on the fly by an external
+    process (pigz, pbzip2, zstd, ... when available) or by the Python
+    modules. Appending to a compressed file adds a new stream.
+    """
+
+    fmt = _EXTENSIONS.get(os.path.splitext(fn)[1].lower())
+    if fmt is None:
+        return open(fn, mode)
+
+    cmd = _find_cmd(_COMPRESS_CMDS[fmt])
+    if cmd is None:
+        compressor = _compressor_python(fmt)
+        return _CompressedFile(open(fn, mode), compressor)
+
+    stderr = tempfile.TemporaryFile()
+    with open(fn, mode) as output_handle:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=output_handle, stderr=stderr,
+                                bufsize=_BUFFER_SIZE, close_fds=True)
+    return _ProcessFile(proc, proc.stdin, stderr, fn)
+
+
+def is_compressed_output(fn):
+    """Returns True if the output file will be compressed by open_output().
+    """
+
+    return os.path.splitext(fn)[1].lower() in _EXTENSIONS
+
+
+class InputFifo(object):
+    """Makes a compressed file readable by external programs which do not
+    support compression (or not all formats, like VSEARCH). If the file is
+    compressed, 'name' is a named pipe created in 'dir', fed with the
+    decompressed data by a thread (see open_input()). Otherwise 'name' is
+    the file name itself. close() must be called after the reader has
+    terminated: it raises IOError if the decompression failed.
+    """
+
+    def __init__(self, fn, dir):
+        self.name = fn
+        self.__fifo_dir = None
+        self.__thread = None
+        self.__error = None
+
+        if compression(fn) is None:
+            return
+
+        self.__fifo_dir = tempfile.mkdtemp(prefix="tmp", dir=dir)
+        # no extension, some programs detect the compression by extension
+        self.name = os.path.join(self.__fifo_dir, "input")
+        os.mkfifo(self.name)
+
+        self.__thread = threading.Thread(target=self.__feed, args=(fn, ))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __feed(self, fn):
+        try:
+            with open_input(fn, 'rb') as input_handle:
+                with open(self.name, 'wb') as fifo_handle:
+                    shutil.copyfileobj(input_handle, fifo_handle,
+                                       _BUFFER_SIZE)
+        except IOError as err:
+            self.__error = err
+        except Exception as err:
+            self.__error = IOError(str(err))
+
+    def close(self):
+        if self.__thread is None:
+            return
+
+        # the reader has terminated: unblock the feeder if it is still
+        # waiting for the fifo to be opened (it then fails writing)
+        while self.__thread.is_alive():
+            os.close(os.open(self.name, os.O_RDONLY | os.O_NONBLOCK))
+            self.__thread.join(0.1)
+        self.__thread = None
+        shutil.rmtree(self.__fifo_dir, ignore_errors=True)
+
+        # a broken pipe means that the reader has stopped early
+        if (self.__error is not None) and \
+           (getattr(self.__error, "errno", None) != errno.EPIPE):
+            raise self.__error
+
+
+class OutputPool:
+    """Pool of output files, opened on demand with the function
+    opener(filename, mode). At most 'maxfiles' files are kept open at the
+    same time: when the limit is reached, the least recently used file is
+    closed. Files are opened in write mode ('wb') the first time and in
+    append mode ('ab') when they are opened again.
+    """
+
+    def __init__(self, opener=open, maxfiles=64):
+        if maxfiles < 1:
+            raise ValueError("maxfiles must be >= 1")
+        self.__opener = opener
+        self.__maxfiles = maxfiles
+        self.__handles = collections.OrderedDict()
+        self.__created = set()
+
+    def get(self, fn):
+        """Returns the open handle of the file 'fn'.
+        """
+
+        try:
+            handle = self.__handles.pop(fn)
+        except KeyError:
+            if len(self.__handles) >= self.__maxfiles:
+                self.__handles.popitem(last=False)[1].close()
+            if fn in self.__created:
+                handle = self.__opener(fn, 'ab')
+            else:
+                handle = self.__opener(fn, 'wb')
+                self.__created.add(fn)
+        self.__handles[fn] = handle
+        return handle
+
+    def close(self):
+        """Closes all the open files.
+        """
+
+        while self.__handles:
+            self.__handles.popitem(last=False)[1].close()
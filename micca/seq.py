@@ -1,6 +1,123 @@
 import os
 import re
-from Bio import SeqIO
+import itertools
+
+import numpy as np
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+
+import micca.ioutils
+
+
+# maximum number of lines inspected to find a FASTQ record boundary
+_SYNC_MAXLINES = 8
+
+FASTQ_ASCII = 33
+
+# size hint in bytes of the blocks of lines read by append_handle()
+_APPEND_BLOCK_SIZE = 4*1024*1024
+
+# probability of error for each quality character (phred+33)
+_PE_LUT = 10**(-(np.arange(128) - FASTQ_ASCII) / 10.)
+
+# range of the quality scores accepted by filter_records() (as VSEARCH)
+_FILTER_QMIN, _FILTER_QMAX = 0, 41
+
+# number of records processed at a time by filter_records() and
+# reservoir_sample()
+_BLOCK_SIZE = 4096
+
+
+def sample_title(title, sample_name):
+    """Returns the title with the sample name appended to the sequence
+    identifier (e.g. SEQID;sample=SAMPLENAME DESCRIPTION), in the same form
+    as Bio.SeqIO.write().
+    """
+
+    fields = title.split(None, 1)
+    new_title = "{0};sample={1}".format(fields[0] if fields else "",
+                                        sample_name)
+    if len(fields) > 1:
+        rest = fields[1].rstrip()
+        if rest:
+            new_title = "{0} {1}".format(new_title, rest)
+    return new_title
+
+
+def _sample_header(line, marker, sample_name):
+    """Returns the header line with the sample name appended to the
+    sequence identifier (see sample_title()).
+    """
+
+    return marker + sample_title(line[1:], sample_name) + "\n"
+
+
+def append_handle(input_handle, output_handle, sample_name, fmt="fastq"):
+    """Appends the sequences read from the input file handle to the output
+    file handle, appending the sample name to the sequence identifier
+    (e.g. >SEQID;sample=SAMPLENAME). Only the header lines are rewritten
+    (every 4th line in FASTQ files, lines starting with '>' in FASTA
+    files), the other lines are copied in blocks. Multi-line FASTQ files
+    are not supported.
+    """
+
+    if fmt == "fastq":
+        marker = '@'
+    elif fmt == "fasta":
+        marker = '>'
+    else:
+        raise ValueError("format {} not supported".format(fmt))
+
+    nlines, blank, last = 0, False, "\n"
+    while True:
+        lines = input_handle.readlines(_APPEND_BLOCK_SIZE)
+        if not lines:
+            break
+
+        if blank:
+            if "".join(lines).strip():
+                raise ValueError("invalid FASTQ file (blank line between "
+                                 "records)")
+            continue
+
+        if fmt == "fastq":
+            header_idx = range((-nlines) % 4, len(lines), 4)
+        else:
+            header_idx = [i for i, line in enumerate(lines)
+                          if line.startswith('>')]
+
+        for i in header_idx:
+            line = lines[i]
+            if line.startswith(marker):
+                lines[i] = _sample_header(line, marker, sample_name)
+            elif not "".join(lines[i:]).strip():
+                # blank lines at the end of the file
+                blank = True
+                lines = lines[:i]
+                break
+            else:
+                raise ValueError("invalid FASTQ header '{}' (multi-line "
+                                 "FASTQ files are not supported)".format(
+                                     line.rstrip()))
+
+        if lines:
+            output_handle.writelines(lines)
+            last = lines[-1]
+        nlines += len(lines)
+
+    if (fmt == "fastq") and (nlines % 4 != 0):
+        raise ValueError("truncated FASTQ file")
+    if not last.endswith("\n"):
+        output_handle.write("\n")
+
+
+def file_sample_name(input_fn, sep=".", sample_name=None):
+    """Returns the sample name of the input file as defined in append().
+    """
+
+    if sample_name is None:
+        sample_name = os.path.basename(input_fn).split(sep)[0]
+    return re.sub('\s+', '_', sample_name)
 
 
 def append(input_fn, output_handle, fmt="fastq", sep=".", sample_name=None):
@@ -11,23 +128,360 @@ def append(input_fn, output_handle, fmt="fastq", sep=".", sample_name=None):
     of 'sep' if 'sample_name' is None; ii) 'sample_name' if
     'sample_name' is a string. Moreover, any whitespace character in
     the sample name is replaced with a single character underscore
-    ('_').
-    """
-    
-    def append_sample_name(records, sample_name):
-        for record in records:
-            record.id = "{0};sample={1}".format(record.id, sample_name)
-            try:
-                description = record.description.split(None, 1)[1]
-            except IndexError:
-                description = ""
-            record.description = description
-            yield record
+    ('_'). See append_handle().
+    """
 
-    if sample_name is None:
-        sample_name = os.path.basename(input_fn).split(sep)[0]
-        
-    sample_name_nows = re.sub('\s+', '_', sample_name)
-    records_in = SeqIO.parse(input_fn, fmt)
-    records_out = append_sample_name(records_in, sample_name_nows)
-    SeqIO.write(records_out, output_handle, fmt)
+    sample_name_nows = file_sample_name(input_fn, sep, sample_name)
+    with micca.ioutils.open_input(input_fn, 'rU') as input_handle:
+        append_handle(input_handle, output_handle, sample_name_nows, fmt)
+
+
+def raw_records(handle, fmt="fastq"):
+    """Yields the records in the input file handle as (title, sequence,
+    quality) string tuples, without building SeqRecord objects. The quality
+    is None for FASTA files.
+    """
+
+    if fmt == "fastq":
+        return FastqGeneralIterator(handle)
+    elif fmt == "fasta":
+        return ((title, seq, None) for title, seq in SimpleFastaParser(handle))
+    else:
+        raise ValueError("format {} not supported".format(fmt))
+
+
+def raw_write(handle, title, seq, qual=None, fmt="fastq", wrap=60):
+    """Writes a record given as strings to the output file handle, in the
+    same layout as Bio.SeqIO.write(). FASTA sequences are wrapped every
+    'wrap' characters (no wrapping if wrap is None).
+    """
+
+    if fmt == "fastq":
+        handle.write("@{}\n{}\n+\n{}\n".format(title, seq, qual))
+    elif fmt == "fasta":
+        handle.write(">{}\n".format(title))
+        if wrap is None:
+            wrap = max(len(seq), 1)
+        for i in range(0, len(seq), wrap):
+            handle.write(seq[i:i+wrap] + "\n")
+    else:
+        raise ValueError("format {} not supported".format(fmt))
+
+
+def _fastq_sync(handle, pos):
+    """Returns the offset of the first FASTQ record starting at or after
+    the position 'pos'. Returns the size of the file if no record is found
+    before the end of the file.
+    """
+
+    handle.seek(max(pos-1, 0))
+    if pos > 0:
+        handle.readline()
+    offset = handle.tell()
+    lines = [handle.readline() for i in range(_SYNC_MAXLINES)]
+
+    # a header line is followed by the sequence and by the '+' line. A
+    # quality line starting with '@' is followed by the header and the
+    # sequence of the next record.
+    for i in range(_SYNC_MAXLINES-2):
+        if lines[i+2] == "":
+            break
+        if lines[i].startswith('@') and lines[i+2].startswith('+'):
+            return offset + sum(len(line) for line in lines[:i])
+
+    if lines[-1] != "":
+        raise ValueError("unable to find a FASTQ record boundary near "
+                         "position {:d} (multi-line FASTQ files are not "
+                         "supported)".format(pos))
+    handle.seek(0, os.SEEK_END)
+    return handle.tell()
+
+
+def _fasta_sync(handle, pos):
+    """Returns the offset of the first FASTA record starting at or after
+    the position 'pos'. Returns the size of the file if no record is found
+    before the end of the file.
+    """
+
+    handle.seek(max(pos-1, 0))
+    if pos > 0:
+        handle.readline()
+    while True:
+        offset = handle.tell()
+        line = handle.readline()
+        if (line == "") or line.startswith('>'):
+            return offset
+
+
+def _chunks(input_fn, chunk_size, sync):
+    """Splits the file in chunks of about 'chunk_size' bytes, aligned to
+    the record boundaries found by the function 'sync'.
+    """
+
+    size = os.path.getsize(input_fn)
+    offsets = [0]
+    with open(input_fn, 'rb') as handle:
+        pos = chunk_size
+        while pos < size:
+            start = sync(handle, pos)
+            if start >= size:
+                break
+            offsets.append(start)
+            pos = start + chunk_size
+    offsets.append(size)
+
+    return zip(offsets[:-1], offsets[1:])
+
+
+def fastq_chunks(input_fn, chunk_size):
+    """Splits the FASTQ file in chunks of about 'chunk_size' bytes, aligned
+    to record boundaries. Returns a list of (start, end) byte offsets.
+    Multi-line FASTQ files are not supported.
+    """
+
+    return _chunks(input_fn, chunk_size, _fastq_sync)
+
+
+def fasta_chunks(input_fn, chunk_size):
+    """Splits the FASTA file in chunks of about 'chunk_size' bytes, aligned
+    to record boundaries. Returns a list of (start, end) byte offsets.
+    """
+
+    return _chunks(input_fn, chunk_size, _fasta_sync)
+
+
+def fastq_read_chunk(input_fn, start, end):
+    """Returns the list of (title, sequence, quality) string tuples of the
+    FASTQ records between the byte offsets 'start' and 'end' (see
+    fastq_chunks()). Titles are returned as they are, without the leading
+    '@'.
+    """
+
+    with open(input_fn, 'rb') as handle:
+        handle.seek(start)
+        data = handle.read(end-start)
+
+    return fastq_parse_block(data, input_fn)
+
+
+def fastq_blocks(handle, size):
+    """Yields blocks of about 'size' bytes of FASTQ records read from the
+    handle (e.g. of a compressed file, see micca.ioutils.open_input()), as
+    strings. Multi-line FASTQ files are not supported.
+    """
+
+    rest = []
+    while True:
+        lines = handle.readlines(size)
+        if not lines:
+            break
+        lines = rest + lines
+        n = len(lines) - (len(lines) % 4)
+        rest = lines[n:]
+        if n > 0:
+            yield "".join(lines[:n])
+    if rest:
+        yield "".join(rest)
+
+
+def fastq_parse_block(data, input_fn):
+    """Returns the list of (title, sequence, quality) string tuples of the
+    FASTQ records in the string 'data' (see fastq_read_chunk()). input_fn
+    is used in error messages only.
+    """
+
+    lines = data.splitlines()
+    if (len(lines) % 4) != 0:
+        raise ValueError("{}: truncated FASTQ record or multi-line FASTQ "
+                         "file".format(input_fn))
+
+    titles, seqs, quals = lines[0::4], lines[1::4], lines[3::4]
+    for title, seq, plus, qual in zip(titles, seqs, lines[2::4], quals):
+        if not (title.startswith('@') and plus.startswith('+') and
+                len(seq) == len(qual)):
+            raise ValueError("{}: invalid FASTQ record {}".format(
+                input_fn, title))
+
+    return [(title[1:], seq, qual)
+            for title, seq, qual in zip(titles, seqs, quals)]
+
+
+def fastq_sample(input_fn, size, seed=0):
+    """Returns about 'size' (title, sequence, quality) string tuples sampled
+    from the FASTQ file without reading it entirely. Records are sampled at
+    random byte offsets: each offset is moved to the start of the next
+    record (the first one after the end of the file), so a record is chosen
+    with probability proportional to the size of the previous one. When
+    consecutive records are independent (as reads in a sequencing run), the
+    sample is unbiased. Records sampled more than once are returned once.
+    Multi-line FASTQ files are not supported. Compressed files can not be
+    read at random positions: 'size' records are sampled reading the whole
+    file (see reservoir_sample()).
+    """
+
+    if micca.ioutils.compression(input_fn) is not None:
+        with micca.ioutils.open_input(input_fn, 'rU') as handle:
+            return reservoir_sample(FastqGeneralIterator(handle), size, seed)
+
+    filesize = os.path.getsize(input_fn)
+    if filesize == 0:
+        return []
+
+    rng = np.random.RandomState(seed)
+    offsets = np.sort(rng.randint(0, filesize, size=size, dtype=np.int64))
+
+    records, starts = [], set()
+    with open(input_fn, 'rb') as handle:
+        for offset in offsets:
+            start = _fastq_sync(handle, int(offset))
+            if start >= filesize:
+                start = 0
+            if start in starts:
+                continue
+            starts.add(start)
+
+            handle.seek(start)
+            title, seq, plus, qual = [handle.readline().rstrip("\r\n")
+                                      for i in range(4)]
+            if not (title.startswith('@') and plus.startswith('+') and
+                    len(seq) == len(qual)):
+                raise ValueError("{}: invalid FASTQ record {}".format(
+                    input_fn, title))
+            records.append((title[1:], seq, qual))
+
+    return records
+
+
+def reservoir_sample(records, size, seed=0):
+    """Returns 'size' records sampled uniformly at random from the iterable
+    (all the records if they are fewer), reading it once (reservoir
+    sampling). Random numbers are drawn in blocks of records.
+    """
+
+    rng = np.random.RandomState(seed)
+    records = iter(records)
+    sample = list(itertools.islice(records, size))
+    nseen = len(sample)
+    while True:
+        block = list(itertools.islice(records, _BLOCK_SIZE))
+        if not block:
+            break
+
+        # the i-th record replaces a random record of the sample with
+        # probability size/i
+        idx = (rng.random_sample(len(block)) *
+               np.arange(nseen+1, nseen+len(block)+1)).astype(np.int64)
+        for i in np.flatnonzero(idx < size):
+            sample[idx[i]] = block[i]
+        nseen += len(block)
+
+    return sample
+
+
+def sample_pct_bound(size, z=1.96):
+    """Returns the half-width of the confidence interval (95% by default)
+    of a percentage estimated on a random sample of 'size' reads, in the
+    worst case (50%).
+    """
+
+    return z * np.sqrt(0.25 / size) * 100
+
+
+def qual_matrix(quals):
+    """Returns the lengths of the quality strings, the 2-D array (reads x
+    positions) of the quality characters (padded with zeros) and the mask of
+    the valid positions.
+    """
+
+    lens = np.array([len(q) for q in quals], dtype=np.int)
+    mask = np.arange(lens.max()) < lens[:, np.newaxis]
+    qualint = np.zeros(mask.shape, dtype=np.uint8)
+    qualint[mask] = np.frombuffer("".join(quals), dtype=np.uint8)
+    return lens, qualint, mask
+
+
+def eerate_matrix(qualint, mask):
+    """Returns the expected error rate % at each position of each read
+    (0 outside the reads) from the output of qual_matrix().
+    """
+
+    # probability of error
+    pe = np.where(mask, _PE_LUT[qualint], 0.)
+
+    # expected error
+    ee = np.cumsum(pe, axis=1)
+
+    # expected error rate %
+    eerate = (ee / np.arange(1, qualint.shape[1]+1)) * 100
+    eerate[~mask] = 0.
+    return eerate
+
+
+def _filter_block(block, maxee_rate, maxns, minlen, trunclen):
+    """Returns the boolean array of the records in the block passing the
+    filter and the lengths of the records after the truncation. See
+    filter_records().
+    """
+
+    lens = np.array([len(seq) for title, seq, qual in block], dtype=np.int)
+    if trunclen is not None:
+        lens = np.where(lens >= trunclen, trunclen, 0)
+
+    quals = [qual[:l] for (title, seq, qual), l in zip(block, lens)]
+    seqs = [seq[:l] for (title, seq, qual), l in zip(block, lens)]
+
+    ee = np.zeros(len(block), dtype=np.float)
+    ncount = np.zeros(len(block), dtype=np.int)
+    if lens.sum() > 0:
+        _, qualint, mask = qual_matrix(quals)
+
+        q = qualint[mask].astype(np.int) - FASTQ_ASCII
+        if q.min() < _FILTER_QMIN:
+            raise ValueError("FASTQ quality value ({:d}) below qmin "
+                             "({:d})".format(q.min(), _FILTER_QMIN))
+        if q.max() > _FILTER_QMAX:
+            raise ValueError("FASTQ quality value ({:d}) above qmax "
+                             "({:d})".format(q.max(), _FILTER_QMAX))
+
+        # expected error, summed along the read as VSEARCH does
+        pe = np.where(mask, _PE_LUT[qualint], 0.)
+        ee = np.cumsum(pe, axis=1)[:, -1]
+
+        seqint = np.frombuffer("".join(seqs), dtype=np.uint8)
+        isn = np.zeros(mask.shape, dtype=np.bool)
+        isn[mask] = (seqint == ord('N')) | (seqint == ord('n'))
+        ncount = isn.sum(axis=1)
+
+    passed = lens >= minlen
+    if trunclen is not None:
+        passed &= lens >= trunclen
+    if maxns is not None:
+        passed &= ncount <= maxns
+    nonzero = lens > 0
+    eerate = np.zeros(len(block), dtype=np.float)
+    eerate[nonzero] = ee[nonzero] / lens[nonzero]
+    passed &= eerate <= maxee_rate / 100.
+
+    return passed, lens
+
+
+def filter_records(records, maxee_rate, maxns=None, minlen=1, trunclen=None):
+    """Filters an iterable of (title, sequence, quality) string tuples,
+    yielding the records with expected error rate % <= 'maxee_rate', at
+    most 'maxns' Ns and length >= 'minlen'. If 'trunclen' is not None,
+    records longer than 'trunclen' are truncated and shorter ones are
+    discarded. Records are processed in blocks, with the same semantics of
+    VSEARCH --fastq_filter (quality scores must be in the range 0-41).
+    """
+
+    records = iter(records)
+    while True:
+        block = list(itertools.islice(records, _BLOCK_SIZE))
+        if not block:
+            break
+
+        passed, lens = _filter_block(block, maxee_rate, maxns, minlen,
+                                     trunclen)
+        for (title, seq, qual), keep, l in zip(block, passed, lens):
+            if keep:
+                yield title, seq[:l], qual[:l]
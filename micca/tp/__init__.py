@@ -1,8 +1,9 @@
-from ._cutadapt import cutadapt, CutadaptError
+from ._cutadapt import cutadapt, cutadapt_pipe, cutadapt_stream, CutadaptError
 from ._fasttree import fasttree, FastTreeError
 from ._swarm import swarm, SwarmError
 import vsearch
 import muscle
 import rdp
 
-__all__ = ["cutadapt", "CutadaptError", "fasttree", "FastTreeError"]
+__all__ = ["cutadapt", "cutadapt_pipe", "cutadapt_stream", "CutadaptError",
+           "fasttree", "FastTreeError"]
@@ -23,6 +23,7 @@ import subprocess
 import string
 import os
 import sys
+import tempfile
 from distutils.spawn import find_executable
 
 from Bio.Seq import Seq
@@ -32,25 +33,77 @@ class CutadaptError(Exception):
     pass
 
 
-def _cutadapt_cmd(params):
+def _cutadapt_bin():
     cutadapt_bin = find_executable("cutadapt")
     if cutadapt_bin is None:
-        CutadaptError("Error: cutadapt is not installed\n")
-    
-    params.insert(0, cutadapt_bin)
+        raise CutadaptError("cutadapt is not installed")
+    return cutadapt_bin
+
+
+def _cutadapt_cmd(params):
+    params.insert(0, _cutadapt_bin())
+    # when the output is a file, cutadapt writes error messages to stdout
     proc = subprocess.Popen(params, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
+                            stderr=subprocess.STDOUT)
     proc_stdout, proc_stderr = proc.communicate()
     if proc.returncode:
-        raise CutadaptError(proc_stderr)
+        raise CutadaptError(proc_stdout)
 
-    
-def cutadapt(input_fn, output_fn, adapter=None, front=None, error_rate=0.1, 
-             minimum_length=0, discard_untrimmed=False, fmt="fastq", 
-             overlap=3, search_rc=False):
-    
-    params = [input_fn, "-o", output_fn, "-e", str(error_rate), "--format", fmt,
-              "--minimum-length", str(minimum_length), "--overlap", str(overlap)]
+
+# minimum cutadapt version supporting --cores (on Python 2, cutadapt < 2.0
+# refuses to run in parallel mode and cutadapt >= 2.0 is not available)
+_CUTADAPT_CORES_MIN_VERSION = (2, 0)
+
+_cutadapt_version_cache = []
+
+
+def _cutadapt_version():
+    """Returns the cutadapt version as a tuple of integers."""
+
+    if not _cutadapt_version_cache:
+        proc = subprocess.Popen([_cutadapt_bin(), "--version"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        proc_stdout, proc_stderr = proc.communicate()
+        if proc.returncode:
+            raise CutadaptError(proc_stdout)
+        version = []
+        for field in proc_stdout.strip().split("."):
+            if not field.isdigit():
+                break
+            version.append(int(field))
+        _cutadapt_version_cache.append(tuple(version))
+    return _cutadapt_version_cache[0]
+
+
+def _check_cores(cores):
+    """Raises CutadaptError if cutadapt cannot run on multiple cores."""
+
+    if cores > 1:
+        version = _cutadapt_version()
+        if version < _CUTADAPT_CORES_MIN_VERSION:
+            raise CutadaptError(
+                "parallel trimming (cores={}) requires cutadapt >= {} running "
+                "on Python 3, found cutadapt {}".format(
+                    cores, ".".join(map(str, _CUTADAPT_CORES_MIN_VERSION)),
+                    ".".join(map(str, version))))
+
+
+def _cutadapt_params(adapter=None, front=None, error_rate=0.1,
+                     minimum_length=0, discard_untrimmed=False, fmt="fastq",
+                     overlap=3, search_rc=False, cores=1):
+
+    _check_cores(cores)
+
+    params = ["-e", str(error_rate), "--minimum-length", str(minimum_length),
+              "--overlap", str(overlap)]
+
+    # --format cannot be used together with --cores, in which case the
+    # format is detected by cutadapt
+    if cores > 1:
+        params.extend(["--cores", str(cores)])
+    else:
+        params.extend(["--format", fmt])
 
     if adapter is not None:
         for a in adapter:
@@ -66,5 +119,93 @@ def cutadapt(input_fn, output_fn, adapter=None, front=None, error_rate=0.1,
     
     if discard_untrimmed:
         params.append("--discard-untrimmed")
-        
+
+    return params
+
+    
+def cutadapt(input_fn, output_fn, adapter=None, front=None, error_rate=0.1, 
+             minimum_length=0, discard_untrimmed=False, fmt="fastq", 
+             overlap=3, search_rc=False, cores=1):
+    
+    params = [input_fn, "-o", output_fn] + _cutadapt_params(
+        adapter=adapter, front=front, error_rate=error_rate,
+        minimum_length=minimum_length, discard_untrimmed=discard_untrimmed,
+        fmt=fmt, overlap=overlap, search_rc=search_rc, cores=cores)
+
     _cutadapt_cmd(params)
+
+
+def _cutadapt_chain(input_fn, params_list, output_fn=None, func=None):
+    """Runs a chain of cutadapt processes (one for each list of parameters
+    in params_list), each one reading the output of the previous one through
+    a pipe. The last process writes the output file or, if output_fn is
+    None, its standard output is read by calling func(handle). Messages are
+    redirected to temporary files, so that a process filling the stderr pipe
+    cannot block.
+    """
+
+    cutadapt_bin = _cutadapt_bin()
+    stderrs = [tempfile.TemporaryFile() for params in params_list]
+    procs = []
+    try:
+        try:
+            stdin = None
+            for i, params in enumerate(params_list):
+                cmd = [cutadapt_bin, input_fn if stdin is None else "-"]
+                if (i == len(params_list)-1) and (output_fn is not None):
+                    # when the output is a file, cutadapt writes error
+                    # messages to stdout
+                    cmd.extend(["-o", output_fn])
+                    stdout, stderr = stderrs[i], subprocess.STDOUT
+                else:
+                    stdout, stderr = subprocess.PIPE, stderrs[i]
+                procs.append(subprocess.Popen(cmd + params, stdin=stdin,
+                                              stdout=stdout, stderr=stderr))
+                # the pipe is now owned by the new process
+                if stdin is not None:
+                    stdin.close()
+                stdin = procs[-1].stdout
+
+            if output_fn is None:
+                func(stdin)
+        except:
+            for proc in procs:
+                proc.kill()
+            raise
+        finally:
+            if stdin is not None:
+                stdin.close()
+            for proc in procs:
+                proc.wait()
+
+        for proc, stderr in reversed(zip(procs, stderrs)):
+            if proc.returncode:
+                stderr.seek(0)
+                raise CutadaptError(stderr.read())
+    finally:
+        for stderr in stderrs:
+            stderr.close()
+
+
+def cutadapt_pipe(input_fn, output_fn, first, second):
+    """Runs two cutadapt processes: the output of the first is piped into
+    the second, without intermediate files. 'first' and 'second' are dicts
+    of cutadapt() keyword arguments (input_fn and output_fn excluded).
+    """
+
+    _cutadapt_chain(input_fn, [_cutadapt_params(**first),
+                               _cutadapt_params(**second)],
+                    output_fn=output_fn)
+
+
+def cutadapt_stream(input_fn, func, first, second=None):
+    """As cutadapt_pipe(), but the trimmed reads are written to a pipe, read
+    by calling func(handle). If 'second' is None, a single cutadapt process
+    is run.
+    """
+
+    params_list = [_cutadapt_params(**first)]
+    if second is not None:
+        params_list.append(_cutadapt_params(**second))
+
+    _cutadapt_chain(input_fn, params_list, func=func)
@@ -2,12 +2,13 @@ import subprocess
 import string
 import os
 import sys
+import tempfile
 
 from micca import THIRDPARTY_BIN_PATH
 
 __all__ = ["VSEARCHError", "sortbysize", "derep_fulllength", "uchime_denovo",
            "cluster_smallmem", "usearch_global", "fastq_filter",
-           "fastx_subsample", "fastq_mergepairs"]
+           "fastx_subsample", "fastq_mergepairs", "fastq_mergepairs_pipe"]
 
 
 class VSEARCHError(Exception):
@@ -24,6 +25,34 @@ def _vsearch_cmd(params):
         raise VSEARCHError(proc_stderr)
 
 
+def _vsearch_pipe(params, func):
+    """Runs VSEARCH calling func(handle) on its standard output. The
+    standard error is redirected to a temporary file, so that a VSEARCH
+    process filling the stderr pipe cannot block.
+    """
+
+    vsearch_bin = os.path.join(THIRDPARTY_BIN_PATH, "vsearch")
+    params.insert(0, vsearch_bin)
+    stderr_handle = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(params, stdout=subprocess.PIPE,
+                                stderr=stderr_handle)
+        try:
+            func(proc.stdout)
+        except:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+        if proc.returncode:
+            stderr_handle.seek(0)
+            raise VSEARCHError(stderr_handle.read())
+    finally:
+        stderr_handle.close()
+
+
 def sortbysize(input_fn, output_fn, minsize=1, xsize=False):
 
     params = ["--sortbysize", input_fn, "--minsize", str(minsize), "--output",
@@ -146,7 +175,8 @@ def usearch_global(input_fn, db_fn, userout_fn=None, fastapairs_fn=None,
                    dbnotmatched_fn=None, ident=0.97, threads=1, query_cov=None,
                    maxaccepts=1, maxrejects=32, userfields="query+target+id",
                    dbmask='dust', qmask='dust', top_hits_only=False,
-                   output_no_hits=False, strand="plus", sizeout=False):
+                   output_no_hits=False, strand="plus", sizeout=False,
+                   otutabout_fn=None):
 
     params = ["--usearch_global", input_fn, "--db",
               db_fn, "--id", str(ident), "--threads", str(threads),
@@ -166,6 +196,8 @@ def usearch_global(input_fn, db_fn, userout_fn=None, fastapairs_fn=None,
         params.extend(["--dbnotmatched", dbnotmatched_fn])
     if fastapairs_fn is not None:
         params.extend(["--fastapairs", fastapairs_fn])
+    if otutabout_fn is not None:
+        params.extend(["--otutabout", otutabout_fn])
     if output_no_hits:
         params.append("--output_no_hits")
     if top_hits_only:
@@ -223,12 +255,13 @@ def fastx_subsample(input_fn, fastaout_fn=None, fastqout_fn=None,
     _vsearch_cmd(params)
 
 
-def fastq_mergepairs(forward_fn, reverse_fn, fastaout_fn=None, fastqout_fn=None,
-                     fastaout_notmerged_fwd_fn=None, fastaout_notmerged_rev_fn=None,
-                     fastqout_notmerged_fwd_fn=None, fastqout_notmerged_rev_fn=None,
-                     fastq_minovlen=10, fastq_maxdiffs=5,
-                     fastq_allowmergestagger=False, fastq_nostagger=True,
-                     threads=1):
+def _fastq_mergepairs_params(forward_fn, reverse_fn, fastaout_fn=None,
+                             fastqout_fn=None, fastaout_notmerged_fwd_fn=None,
+                             fastaout_notmerged_rev_fn=None,
+                             fastqout_notmerged_fwd_fn=None,
+                             fastqout_notmerged_rev_fn=None, fastq_minovlen=10,
+                             fastq_maxdiffs=5, fastq_allowmergestagger=False,
+                             fastq_nostagger=True, threads=1):
 
     params = ["--fastq_mergepairs", forward_fn, "--reverse", reverse_fn,
               "--fastq_maxdiffs", str(fastq_maxdiffs), "--fastq_minovlen",
@@ -251,4 +284,40 @@ def fastq_mergepairs(forward_fn, reverse_fn, fastaout_fn=None, fastqout_fn=None,
     if fastq_nostagger:
         params.extend(["--fastq_nostagger"])
 
+    return params
+
+
+def fastq_mergepairs(forward_fn, reverse_fn, fastaout_fn=None, fastqout_fn=None,
+                     fastaout_notmerged_fwd_fn=None, fastaout_notmerged_rev_fn=None,
+                     fastqout_notmerged_fwd_fn=None, fastqout_notmerged_rev_fn=None,
+                     fastq_minovlen=10, fastq_maxdiffs=5,
+                     fastq_allowmergestagger=False, fastq_nostagger=True,
+                     threads=1):
+
+    params = _fastq_mergepairs_params(
+        forward_fn, reverse_fn, fastaout_fn, fastqout_fn,
+        fastaout_notmerged_fwd_fn, fastaout_notmerged_rev_fn,
+        fastqout_notmerged_fwd_fn, fastqout_notmerged_rev_fn, fastq_minovlen,
+        fastq_maxdiffs, fastq_allowmergestagger, fastq_nostagger, threads)
+
     _vsearch_cmd(params)
+
+
+def fastq_mergepairs_pipe(forward_fn, reverse_fn, func,
+                          fastqout_notmerged_fwd_fn=None,
+                          fastqout_notmerged_rev_fn=None, fastq_minovlen=10,
+                          fastq_maxdiffs=5, fastq_allowmergestagger=False,
+                          fastq_nostagger=True, threads=1):
+    """As fastq_mergepairs(), but the merged reads (FASTQ) are written to a
+    pipe, read by calling func(handle).
+    """
+
+    params = _fastq_mergepairs_params(
+        forward_fn, reverse_fn, fastqout_fn="/dev/stdout",
+        fastqout_notmerged_fwd_fn=fastqout_notmerged_fwd_fn,
+        fastqout_notmerged_rev_fn=fastqout_notmerged_rev_fn,
+        fastq_minovlen=fastq_minovlen, fastq_maxdiffs=fastq_maxdiffs,
+        fastq_allowmergestagger=fastq_allowmergestagger,
+        fastq_nostagger=fastq_nostagger, threads=threads)
+
+    _vsearch_pipe(params, func)
@@ -0,0 +1,134 @@
+##    Copyright 2016 Davide Albanese <davide.albanese@gmail.com>
+##    Copyright 2016 Fondazione Edmund Mach (FEM)
+
+##    This file is part of micca.
+##
+##    micca is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    micca is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with micca.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the native filter engine with the VSEARCH engine. The fixture
+data/filter.fastq contains reads with quality values in the whole 0-41
+range, expected error rates at the maxee_rate boundaries and low quality
+or N-rich tails removed by the truncation. Run with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import gzip
+import itertools
+import shutil
+import tempfile
+import unittest
+
+import micca
+import micca.api
+import micca.api._filter
+import micca.tp.vsearch
+
+
+_DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+_VSEARCH_BIN = os.path.join(micca.THIRDPARTY_BIN_PATH, "vsearch")
+
+# maxee_rate (-e), maxns (-n), minlen (-m) and trunc (-t) values
+_MAXEE_RATES = [0.5, 1, 2, 10]
+_MAXNS = [None, 0, 2]
+_MINLENS = [1, 50, 100, 150]
+_TRUNCS = [False, True]
+
+
+@unittest.skipUnless(os.path.isfile(_VSEARCH_BIN), "VSEARCH is not built")
+class FilterEnginesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_fn = os.path.join(_DATA_DIR, "filter.fastq")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _filter(self, engine, output_fmt="fasta", **kwargs):
+        output_fn = os.path.join(self.tmp_dir, "{}.{}".format(
+            engine, output_fmt))
+        micca.api.filter(self.input_fn, output_fn, output_fmt=output_fmt,
+                         engine=engine, **kwargs)
+        with open(output_fn, 'rb') as output_handle:
+            return output_handle.read()
+
+    def _assert_same(self, **kwargs):
+        vsearch = self._filter("vsearch", **kwargs)
+        native = self._filter("native", **kwargs)
+        self.assertEqual(vsearch, native, kwargs)
+        return vsearch
+
+    def test_options(self):
+        # the combinations must select different subsets of the reads
+        outputs = set()
+        for maxee_rate, maxns, minlen, trunc in itertools.product(
+                _MAXEE_RATES, _MAXNS, _MINLENS, _TRUNCS):
+            outputs.add(self._assert_same(
+                maxee_rate=maxee_rate, maxns=maxns, minlen=minlen,
+                trunc=trunc))
+        self.assertGreater(len(outputs), len(_MINLENS)*len(_TRUNCS))
+
+    def test_fastq_output(self):
+        for trunc in _TRUNCS:
+            self._assert_same(maxee_rate=1, maxns=0, minlen=100, trunc=trunc,
+                              output_fmt="fastq")
+
+    def test_threads(self):
+        # many small chunks processed in parallel
+        chunk_size = micca.api._filter._CHUNK_SIZE
+        micca.api._filter._CHUNK_SIZE = 1024
+        try:
+            for trunc in _TRUNCS:
+                vsearch = self._filter("vsearch", maxee_rate=1, minlen=50,
+                                       trunc=trunc)
+                native = self._filter("native", maxee_rate=1, minlen=50,
+                                      trunc=trunc, threads=2)
+                self.assertEqual(vsearch, native)
+        finally:
+            micca.api._filter._CHUNK_SIZE = chunk_size
+
+    def test_compressed_output(self):
+        # output compressed by the file name extension (both engines), no
+        # temporary files left
+        for engine, output_fmt in itertools.product(["vsearch", "native"],
+                                                    ["fasta", "fastq"]):
+            expected = self._filter(engine, output_fmt=output_fmt,
+                                    maxee_rate=1)
+            output_fn = os.path.join(self.tmp_dir, "output.gz")
+            micca.api.filter(self.input_fn, output_fn, maxee_rate=1,
+                             output_fmt=output_fmt, engine=engine)
+            with gzip.open(output_fn, 'rb') as output_handle:
+                self.assertEqual(output_handle.read(), expected)
+            expected_fn = "{}.{}".format(engine, output_fmt)
+            self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                             sorted([expected_fn, "output.gz"]))
+            os.remove(os.path.join(self.tmp_dir, expected_fn))
+            os.remove(output_fn)
+
+    def test_qmax(self):
+        # quality values above 41 are rejected by both engines
+        self.input_fn = os.path.join(self.tmp_dir, "qmax.fastq")
+        with open(self.input_fn, 'wb') as input_handle:
+            input_handle.write("@r0\nACGT\n+\nIIII\n@r1\nACGT\n+\nIIJK\n")
+
+        self.assertRaises(micca.tp.vsearch.VSEARCHError, self._filter,
+                          "vsearch", maxee_rate=1)
+        self.assertRaises(ValueError, self._filter, "native", maxee_rate=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
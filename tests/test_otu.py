@@ -0,0 +1,83 @@
+##    Copyright 2016 Davide Albanese <davide.albanese@gmail.com>
+##    Copyright 2016 Fondazione Edmund Mach (FEM)
+
+##    This file is part of micca.
+##
+##    micca is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    micca is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+
+##    You should have received a copy of the GNU General Public License
+##    along with micca.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the OTU tables built from the hits file with the ones written
+by VSEARCH (vsearch_otutable=True). Run with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import micca
+import micca.api.otu
+
+
+_VSEARCH_BIN = os.path.join(micca.THIRDPARTY_BIN_PATH, "vsearch")
+
+
+@unittest.skipUnless(os.path.isfile(_VSEARCH_BIN), "VSEARCH is not built")
+class OTUTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_fn = os.path.join(self.tmp_dir, "input.fasta")
+
+        # read ids restart in each sample: the representatives 1;sample=A
+        # and 1;sample=B share the id truncated by VSEARCH at the first ';'
+        rnd = random.Random(3)
+        with open(self.input_fn, 'wb') as input_handle:
+            for sample in ["A", "B"]:
+                seq = "".join(rnd.choice("ACGT") for i in range(200))
+                for i in range(10):
+                    input_handle.write(">{:d};sample={}\n{}\n".format(
+                        i+1, sample, seq))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _otutable(self, func, vsearch_otutable, **kwargs):
+        output_dir = os.path.join(self.tmp_dir, str(vsearch_otutable))
+        os.mkdir(output_dir)
+        func(self.input_fn, output_dir=output_dir,
+             vsearch_otutable=vsearch_otutable, **kwargs)
+        with open(os.path.join(output_dir, "otutable.txt"), 'rb') as handle:
+            return handle.read()
+
+    def _assert_same(self, func, **kwargs):
+        hits = self._otutable(func, False, **kwargs)
+        vsearch = self._otutable(func, True, **kwargs)
+        self.assertEqual(hits, vsearch)
+        return hits
+
+    def test_colliding_ids_denovo_greedy(self):
+        otutable = self._assert_same(micca.api.otu.denovo_greedy)
+        self.assertEqual(otutable, "OTU\tA\tB\nDENOVO1\t10\t0\n"
+                         "DENOVO2\t0\t10\n")
+
+    def test_colliding_ids_open_ref(self):
+        self._assert_same(micca.api.otu.open_ref, ref_fn=self.input_fn,
+                          minsize=1)
+
+
+if __name__ == "__main__":
+    unittest.main()